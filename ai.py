@@ -1,13 +1,24 @@
+import asyncio
 import os
-from typing import List, Generator
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, List
 
 import openai as oai
 import nltk
 import tiktoken
 import google.generativeai as gemini
 
+from embedding_cache import EmbeddingCache
+from query_cache import QueryCache, normalize_query
+
+# caches live under the repo's data directory, wherever the server is started from
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
 # OpenAI client setup, used for text generation
 openai = oai.OpenAI()
+async_openai = oai.AsyncOpenAI()
 
 # Gemini client setup, used for embeddings
 gemini_key = os.environ["GEMINI_KEY"]
@@ -18,19 +29,141 @@ gemini.configure(api_key=gemini_key)
 tiktoken_model = tiktoken.encoding_for_model('gpt-4')
 def tokenize(text: str) -> List[int]:
     return tiktoken_model.encode(text, disallowed_special=())
+def tokenize_batch(texts: List[str]) -> List[List[int]]:
+    return tiktoken_model.encode_batch(texts, disallowed_special=())
 def token_length(text: str) -> int:
-    return len(list(tokenize(text)))
+    return len(tokenize(text))
 def truncate_to(text, max_tokens):
-    truncated_tokens = list(tokenize(text))[:max_tokens]
+    truncated_tokens = tokenize(text)[:max_tokens]
     truncated_s = tiktoken_model.decode(truncated_tokens)
     return truncated_s
 
+class _EmbeddingRequest:
+    def __init__(self, n_inputs: int) -> None:
+        self.future = Future()
+        self.vectors = [None] * n_inputs
+        self.remaining = n_inputs
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batches embedding requests from concurrent callers.
+
+    Texts submitted by any thread or coroutine are queued and sent to `embed` in requests of up to
+    `max_batch` inputs.  A request goes out as soon as it is full, or once the oldest queued text
+    has waited `max_delay` seconds; at most `max_in_flight` requests run at once.  Each caller gets
+    back a Future for exactly its own vectors, in the order it submitted them.
+    """
+    def __init__(self,
+                 embed: Callable[[List[str]], List[List[float]]],
+                 max_batch: int = 100,
+                 max_delay: float = 0.02,
+                 max_in_flight: int = 4) -> None:
+        self.embed = embed
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.n_requests = 0
+        self.n_inputs = 0
+        self._pending = []  # (request, index, text, submitted_at)
+        self._condition = threading.Condition()
+        self._results_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._slots = threading.Semaphore(max_in_flight)
+        threading.Thread(target=self._dispatch, name='embedding-batcher', daemon=True).start()
+
+    def submit(self, inputs: List[str]) -> Future:
+        request = _EmbeddingRequest(len(inputs))
+        if not inputs:
+            request.future.set_result([])
+            return request.future
+        now = time.monotonic()
+        with self._condition:
+            self._pending.extend((request, i, text, now) for i, text in enumerate(inputs))
+            self._condition.notify()
+        return request.future
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = self._pending[0][3] + self.max_delay
+                while len(self._pending) < self.max_batch and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            self._slots.acquire()
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch) -> None:
+        try:
+            vectors = self.embed([text for _, _, text, _ in batch])
+            if len(vectors) != len(batch):
+                # there is no telling which inputs the vectors belong to, so fail every request in the
+                # batch rather than leave the short ones waiting forever
+                raise ValueError(f'Embedding returned {len(vectors)} vectors for {len(batch)} inputs')
+        except Exception as e:
+            for request in {id(request): request for request, _, _, _ in batch}.values():
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        with self._results_lock:
+            self.n_requests += 1
+            self.n_inputs += len(batch)
+            for (request, i, _, _), vector in zip(batch, vectors):
+                request.vectors[i] = vector
+                request.remaining -= 1
+                if request.remaining == 0 and not request.future.done():
+                    request.future.set_result(request.vectors)
+
+
 # Chunk embedding function using Gemini
-def encode(inputs: list[str]) -> list[list[float]]:
-    model = "models/text-embedding-004"
-    result = gemini.embed_content(model=model, content=inputs)
+_embedding_model = "models/text-embedding-004"
+def _embed(inputs: list[str]) -> list[list[float]]:
+    result = gemini.embed_content(model=_embedding_model, content=inputs)
     return result['embedding']
 
+# Gemini accepts at most 100 inputs per batch request
+_batcher = EmbeddingBatcher(_embed, max_batch=100)
+embedding_cache = EmbeddingCache(os.path.join(data_dir, 'embedding_cache'), dimension=768)
+
+def _cache_lookup(inputs: list[str]) -> tuple[list, list[str]]:
+    cached = embedding_cache.get_many(_embedding_model, inputs)
+    # boilerplate chunks often repeat within a page, so only embed each missing text once
+    missing = list(dict.fromkeys(text for text, vector in zip(inputs, cached) if vector is None))
+    return cached, missing
+
+def _cache_fill(inputs: list[str], cached: list, missing: list[str], vectors: list[list[float]]) -> list[list[float]]:
+    embedding_cache.put_many(_embedding_model, missing, vectors)
+    fresh = dict(zip(missing, vectors))
+    return [fresh[text] if vector is None else vector.tolist() for text, vector in zip(inputs, cached)]
+
+def encode(inputs: list[str]) -> list[list[float]]:
+    cached, missing = _cache_lookup(inputs)
+    vectors = _batcher.submit(missing).result()
+    return _cache_fill(inputs, cached, missing, vectors)
+
+async def encode_async(inputs: list[str]) -> list[list[float]]:
+    # the cache reads its files and put_many waits on an flock, so keep both off the event loop
+    cached, missing = await asyncio.to_thread(_cache_lookup, inputs)
+    vectors = await asyncio.wrap_future(_batcher.submit(missing))
+    return await asyncio.to_thread(_cache_fill, inputs, cached, missing, vectors)
+
+# queries get their own cache, so they don't push page chunks out of embedding_cache
+query_cache = QueryCache(os.path.join(data_dir, 'query_cache.sqlite'))
+
+def encode_query(query: str) -> list[float]:
+    # variants of a query share a cache entry, but the model sees the query as it was typed
+    # (the first variant to miss the cache is the one embedded)
+    key = 'query: ' + normalize_query(query)
+    vector = query_cache.get(_embedding_model, key)
+    if vector is None:
+        vector = _batcher.submit(['query: ' + query]).result()[0]
+        query_cache.put(_embedding_model, key, vector)
+    return vector
+
 _summarize_prompt = ("You are an assistant who will give the subject of the provided web page content in as few words as possible. "
                      "Give the subject in a form appropriate for an article or book title with no extra preamble or context."
                      "Examples of good responses: "
@@ -62,8 +195,8 @@ def _group_sentences_by_tokens(sentences: List[str], max_tokens: int) -> List[Li
     current_group = []
     current_token_count = 0
 
-    for sentence in sentences:
-        token_count = len(list(tokenize(sentence)))
+    for sentence, tokens in zip(sentences, tokenize_batch(sentences)):
+        token_count = len(tokens)
         if current_token_count + token_count <= max_tokens:
             current_group.append(sentence)
             current_token_count += token_count
@@ -77,21 +210,51 @@ def _group_sentences_by_tokens(sentences: List[str], max_tokens: int) -> List[Li
 
     return grouped_sentences
 
-def ai_format(text_content: str) -> Generator[str, None, None]:
+def _format_sections(text_content: str) -> List[str]:
     sentences = [sentence.strip() for sentence in nltk.sent_tokenize(text_content)]
     # gpt4o-mini can output 16k tokens, we assume adding the html tags will double the input length
-    sentence_groups = _group_sentences_by_tokens(sentences, 8_000)
-
-    for group in sentence_groups:
-        group_text = ' '.join(group)
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": _format_prompt},
-                {"role": "user", "content": group_text},
-            ],
-            stream=True
-        )
-        for chunk in response:
-            if chunk.choices[0].delta.content is not None:
-                yield chunk.choices[0].delta.content
\ No newline at end of file
+    return [' '.join(group) for group in _group_sentences_by_tokens(sentences, 8_000)]
+
+# sections of a page are formatted by this many concurrent requests at most
+FORMAT_CONCURRENCY = 4
+_SECTION_DONE = object()
+
+async def ai_format_async(text_content: str, max_concurrency: int = FORMAT_CONCURRENCY) -> AsyncGenerator[str, None]:
+    """
+    Formats the sections of a page concurrently, yielding the html in document order: the first
+    section streams as it is generated, and each later one (already partly or fully generated by
+    then) follows as soon as the sections before it have finished.
+    """
+    sentence_groups = await asyncio.to_thread(_format_sections, text_content)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def format_section(group_text: str, pieces: asyncio.Queue) -> None:
+        async with semaphore:
+            try:
+                response = await async_openai.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": _format_prompt},
+                        {"role": "user", "content": group_text},
+                    ],
+                    stream=True
+                )
+                async for chunk in response:
+                    if chunk.choices[0].delta.content is not None:
+                        pieces.put_nowait(chunk.choices[0].delta.content)
+            except Exception as e:
+                pieces.put_nowait(e)
+            pieces.put_nowait(_SECTION_DONE)
+
+    sections = [asyncio.Queue() for _ in sentence_groups]
+    # tasks wait on the semaphore in the order they were created, so sections start in order
+    tasks = [asyncio.create_task(format_section(group, pieces)) for group, pieces in zip(sentence_groups, sections)]
+    try:
+        for pieces in sections:
+            while (piece := await pieces.get()) is not _SECTION_DONE:
+                if isinstance(piece, Exception):
+                    raise piece
+                yield piece
+    finally:
+        for task in tasks:
+            task.cancel()
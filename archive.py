@@ -0,0 +1,202 @@
+import fcntl
+import heapq
+import json
+import os
+import struct
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Set
+
+import numpy as np
+
+import codec
+
+# Each user's raw requests are appended to segment files in <data_dir>/<user_id>/.  A segment is
+# named for the timestamp of its first record and holds length-prefixed records:
+#   int64 timestamp_ns | uint32 payload length | payload (compressed json)
+# Next to each segment, a .idx sidecar holds one (int64 timestamp_ns, uint64 offset) entry per
+# record.  The segment is authoritative; the index is only used to seek by timestamp and to find
+# the end of the last complete record after a crash.
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+_HEADER = struct.Struct('<qI')
+_INDEX_DTYPE = np.dtype([('timestamp_ns', '<i8'), ('offset', '<u8')])
+
+
+class ArchivedRequest(NamedTuple):
+    user_id: str
+    timestamp_ns: int
+    payload: bytes
+
+    def load(self) -> Dict[str, Any]:
+        return decode(self.payload)
+
+
+def encode(request: Dict[str, Any]) -> bytes:
+    return codec.compress(json.dumps(request).encode('utf-8'), 'raw')
+
+
+def decode(payload: bytes) -> Dict[str, Any]:
+    return json.loads(codec.decompress(payload))
+
+
+def append(data_dir: str, user_id: str, request: Dict[str, Any]) -> int:
+    """
+    Durably appends a request to the user's archive.  Safe to call from several processes at once.
+    Returns the record's timestamp, which is unique within the user's archive.
+    """
+    user_dir = os.path.join(data_dir, str(user_id))
+    os.makedirs(user_dir, exist_ok=True)
+    payload = encode(request)
+    with open(os.path.join(user_dir, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        segments = _segments(user_dir)
+        timestamp_ns = time.time_ns()
+        if segments:
+            segment_path = segments[-1]
+            end, last_timestamp_ns = _recover(segment_path)
+            timestamp_ns = max(timestamp_ns, last_timestamp_ns + 1)
+        if not segments or end >= SEGMENT_SIZE:
+            segment_path = os.path.join(user_dir, f'{timestamp_ns}.seg')
+            end = 0
+        with open(segment_path, 'ab') as f:
+            f.write(_HEADER.pack(timestamp_ns, len(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(_index_path(segment_path), 'ab') as f:
+            f.write(np.array([(timestamp_ns, end)], dtype=_INDEX_DTYPE).tobytes())
+    return timestamp_ns
+
+
+def iter_requests(data_dir: str,
+                  user_ids: Optional[Set[str]] = None,
+                  since_ns: Optional[int] = None,
+                  until_ns: Optional[int] = None) -> Iterator[ArchivedRequest]:
+    """
+    Streams archived requests in timestamp order, optionally only for some users and for
+    since_ns <= timestamp < until_ns.  data_dir may also be a single user's directory.
+    Requests archived as one gzip file each (the format before segments) are included.
+    """
+    streams = []
+    for user_dir, files in _user_dirs(data_dir):
+        user_id = os.path.basename(user_dir)
+        if user_ids is None or user_id in user_ids:
+            streams.append(_iter_user(user_dir, files, since_ns, until_ns))
+    return heapq.merge(*streams, key=lambda r: r.timestamp_ns)
+
+
+def user_ids(data_dir: str) -> List[str]:
+    return [os.path.basename(user_dir) for user_dir, _ in _user_dirs(data_dir)]
+
+
+def _iter_user(user_dir: str, files: List[str], since_ns: Optional[int], until_ns: Optional[int]) -> Iterator[ArchivedRequest]:
+    user_id = os.path.basename(user_dir)
+    legacy = sorted(int(fname[:-3]) for fname in files if fname.endswith('.gz') and fname[:-3].isdigit())
+    segments = sorted((os.path.join(user_dir, fname) for fname in files if fname.endswith('.seg')), key=_first_timestamp)
+    def legacy_requests():
+        for timestamp_ns in legacy:
+            if (since_ns is None or timestamp_ns >= since_ns) and (until_ns is None or timestamp_ns < until_ns):
+                with open(os.path.join(user_dir, f'{timestamp_ns}.gz'), 'rb') as f:
+                    yield ArchivedRequest(user_id, timestamp_ns, f.read())
+    def segment_requests():
+        for i, segment_path in enumerate(segments):
+            # skip segments that end before since_ns, and stop at the first that starts after until_ns
+            if since_ns is not None and i + 1 < len(segments) and _first_timestamp(segments[i + 1]) <= since_ns:
+                continue
+            if until_ns is not None and _first_timestamp(segment_path) >= until_ns:
+                return
+            for request in _iter_segment(user_id, segment_path, since_ns):
+                if until_ns is not None and request.timestamp_ns >= until_ns:
+                    return
+                yield request
+    return heapq.merge(legacy_requests(), segment_requests(), key=lambda r: r.timestamp_ns)
+
+
+def _iter_segment(user_id: str, segment_path: str, since_ns: Optional[int]) -> Iterator[ArchivedRequest]:
+    offset = 0
+    if since_ns is not None:
+        index = _read_index(segment_path)
+        i = np.searchsorted(index['timestamp_ns'], since_ns)
+        if i == len(index):
+            offset = int(index['offset'][-1]) if len(index) else 0
+        else:
+            offset = int(index['offset'][i])
+    with open(segment_path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            timestamp_ns, length = _HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return  # torn write at the end of the segment
+            if since_ns is None or timestamp_ns >= since_ns:
+                yield ArchivedRequest(user_id, timestamp_ns, payload)
+
+
+def _user_dirs(data_dir: str):
+    for root, _, files in os.walk(data_dir):
+        if any(fname.endswith('.seg') or fname.endswith('.gz') for fname in files):
+            yield root, files
+
+
+def _segments(user_dir: str) -> List[str]:
+    segments = [os.path.join(user_dir, fname) for fname in os.listdir(user_dir) if fname.endswith('.seg')]
+    return sorted(segments, key=_first_timestamp)
+
+
+def _first_timestamp(segment_path: str) -> int:
+    return int(os.path.basename(segment_path)[:-len('.seg')])
+
+
+def _index_path(segment_path: str) -> str:
+    return segment_path[:-len('.seg')] + '.idx'
+
+
+def _read_index(segment_path: str) -> np.ndarray:
+    index_path = _index_path(segment_path)
+    if not os.path.exists(index_path):
+        return np.empty(0, dtype=_INDEX_DTYPE)
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    # ignore a torn trailing entry
+    return np.frombuffer(data[:len(data) - len(data) % _INDEX_DTYPE.itemsize], dtype=_INDEX_DTYPE)
+
+
+def _recover(segment_path: str) -> tuple[int, int]:
+    """
+    Returns (end offset, last timestamp) of the last complete record in the segment.  If the
+    segment or its index were left inconsistent by a crash, missing index entries are re-added
+    from the segment and a torn record at the end is truncated away.  Caller holds the lock.
+    """
+    index = _read_index(segment_path)
+    size = os.path.getsize(segment_path)
+    offset, last_timestamp_ns = 0, 0
+    with open(segment_path, 'rb+') as f:
+        if len(index):
+            offset, last_timestamp_ns = int(index['offset'][-1]), int(index['timestamp_ns'][-1])
+            f.seek(offset)
+            _, length = _HEADER.unpack(f.read(_HEADER.size))
+            offset += _HEADER.size + length
+            if offset == size:
+                return offset, last_timestamp_ns
+        # scan forward from the last indexed record
+        missing = []
+        f.seek(offset)
+        while True:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            timestamp_ns, length = _HEADER.unpack(header)
+            if offset + _HEADER.size + length > size:
+                break
+            missing.append((timestamp_ns, offset))
+            last_timestamp_ns = timestamp_ns
+            offset += _HEADER.size + length
+            f.seek(offset)
+        if offset < size:
+            f.truncate(offset)
+    with open(_index_path(segment_path), 'wb') as f:
+        f.write(index.tobytes() + np.array(missing, dtype=_INDEX_DTYPE).tobytes())
+    return offset, last_timestamp_ns
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+
+
+class _UserBands:
+    def __init__(self, n_bands: int) -> None:
+        self.bands = np.empty((64, n_bands), dtype=np.uint8)
+        self.url_ids: List[UUID] = []
+        self.rows: Dict[UUID, int] = {}
+        self.newest_loaded: Optional[UUID] = None
+        self.warm = False
+        self.refreshed_at = 0.0
+
+    def add(self, url_id: UUID, bands: np.ndarray) -> None:
+        row = self.rows.get(url_id)
+        if row is None:
+            row = len(self.url_ids)
+            if row == len(self.bands):
+                self.bands = np.concatenate([self.bands, np.empty_like(self.bands)])
+            self.url_ids.append(url_id)
+            self.rows[url_id] = row
+        self.bands[row] = bands
+
+
+class BandIndex:
+    """
+    In-memory LSH band table per user, for finding near-duplicate candidates without an ANN query.
+
+    Each saved page is one row of its quantized band values (one byte per band, the same values
+    that select the slots set in its fingerprint).  The number of bands a page shares with a new
+    page is the same quantity the ANN fingerprint similarity is computed from, so candidates()
+    returns the pages the fingerprint index would rank highest.
+
+    A user's table is "warm" once it has been loaded from the database; until then callers should
+    fall back to the database.  Pages added while a load is in progress are kept.  Only the
+    `max_users` most recently used users' tables are kept (all of them if it is None); the others
+    go cold and are reloaded when next needed.
+    """
+    _REMOVED = 255  # never equal to a band value, so removed rows don't match anything
+
+    def __init__(self, n_bands: int = 64, max_age: float = 60.0, max_users: Optional[int] = 100) -> None:
+        self.n_bands = n_bands
+        self.max_age = max_age
+        self.max_users = max_users
+        self._users: OrderedDict[UUID, _UserBands] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _user(self, user_id: UUID) -> _UserBands:
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _UserBands(self.n_bands)
+            if self.max_users is not None and len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return user
+
+    def is_warm(self, user_id: UUID) -> bool:
+        user = self._users.get(user_id)
+        return user is not None and user.warm
+
+    def is_stale(self, user_id: UUID) -> bool:
+        """True if pages saved by other processes may be missing"""
+        user = self._users.get(user_id)
+        return user is None or time.monotonic() - user.refreshed_at > self.max_age
+
+    def newest_loaded(self, user_id: UUID) -> Optional[UUID]:
+        """The newest url_id loaded from the database, to refresh incrementally from"""
+        user = self._users.get(user_id)
+        return user.newest_loaded if user else None
+
+    def load(self, user_id: UUID, pages: Iterable[Tuple[UUID, np.ndarray]]) -> None:
+        """Add (url_id, bands) pages from the database and mark the user warm"""
+        with self._lock:
+            user = self._user(user_id)
+            for url_id, bands in pages:
+                user.add(url_id, bands)
+                if user.newest_loaded is None or url_id.time > user.newest_loaded.time:
+                    user.newest_loaded = url_id
+            user.warm = True
+            user.refreshed_at = time.monotonic()
+
+    def add(self, user_id: UUID, url_id: UUID, bands: np.ndarray) -> None:
+        with self._lock:
+            self._user(user_id).add(url_id, bands)
+
+    def discard(self, user_id: UUID, url_id: UUID) -> None:
+        with self._lock:
+            user = self._users.get(user_id)
+            row = user.rows.get(url_id) if user else None
+            if row is not None:
+                user.bands[row] = self._REMOVED
+
+    def candidates(self, user_id: UUID, bands: np.ndarray, limit: int, min_matches: int) -> List[Tuple[UUID, int]]:
+        """Up to `limit` (url_id, matching bands) pairs sharing at least min_matches bands, best first"""
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                # evicted since the caller checked is_warm
+                return []
+            self._users.move_to_end(user_id)
+            n = len(user.url_ids)
+            matches = np.count_nonzero(user.bands[:n] == bands, axis=1)
+            rows = np.flatnonzero(matches >= min_matches)
+            rows = rows[np.argsort(matches[rows])[::-1][:limit]]
+            return [(user.url_ids[row], int(matches[row])) for row in rows]
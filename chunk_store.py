@@ -0,0 +1,164 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+from uuid import UUID
+
+import numpy as np
+import xxhash
+
+from db import DB
+
+# The local indexes (mirror.py, lexical.py) keep each user's chunks in a directory of:
+#   entries    one ENTRY_DTYPE entry per chunk: its key, url_id and where its record is
+#   records    appended json {full_url, title, chunk} records
+#   lock       held by writers, so several processes can share the files
+# next to whatever else the index keeps per chunk.  An entry is only visible once it is written,
+# so that is done last.  A chunk that is saved again (chunks are keyed by url_id and ordinal, like
+# in saved_page_chunks) gets a new entry, and the old one is marked dead.
+ENTRY_DTYPE = np.dtype([('key', '<u8'), ('url_id', 'V16'), ('offset', '<u8'), ('length', '<u4'), ('live', 'u1')])
+
+
+def chunk_key(url_id: UUID, ordinal: int) -> int:
+    return xxhash.xxh64_intdigest(url_id.bytes + ordinal.to_bytes(4, 'little'))
+
+
+class UserChunks:
+    """One user's entries and records.  Subclasses name the files and load what they keep alongside."""
+    entries_name: str
+    records_name: str
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.n = 0
+        self.entries = np.empty(0, dtype=ENTRY_DTYPE)
+        self.key_entries: Dict[int, int] = {}
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def refresh(self) -> None:
+        """Maps entries added since the last refresh, by this process or another one"""
+        entries_path = self.file(self.entries_name)
+        n = os.path.getsize(entries_path) // ENTRY_DTYPE.itemsize if os.path.exists(entries_path) else 0
+        if n == self.n:
+            return
+        self.entries = np.memmap(entries_path, dtype=ENTRY_DTYPE, mode='r', shape=(n,))
+        self.key_entries.update(zip(self.entries['key'][self.n:].tolist(), range(self.n, n)))
+        self.n = n
+
+    def records(self, entries: Iterable[int]) -> List[dict]:
+        results = []
+        with open(self.file(self.records_name), 'rb') as f:
+            for entry in entries:
+                f.seek(int(self.entries['offset'][entry]))
+                results.append(json.loads(f.read(int(self.entries['length'][entry]))))
+        return results
+
+    def live_keys(self) -> Set[int]:
+        return {int(key) for key, live in zip(self.entries['key'], self.entries['live']) if live}
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        """Holds the user's locks, in this process and in the others, with the entries refreshed"""
+        with self.lock, open(self.file('lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.refresh()
+            yield
+
+
+class ChunkStore:
+    """
+    Each user's chunks, appended to files under path as pages are saved, with sync() to copy
+    anything missed from the database.  Subclasses add what they index and how they search it.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._users: Dict[UUID, UserChunks] = {}
+        self._lock = threading.Lock()
+
+    def _new_user(self, path: str) -> UserChunks:
+        raise NotImplementedError
+
+    def _user(self, user_id: UUID) -> UserChunks:
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                user = self._users[user_id] = self._new_user(os.path.join(self.path, str(user_id)))
+            return user
+
+    def _append(self, user: UserChunks, url_id: UUID, full_url: str, title: str, chunks: Iterable[str]) -> None:
+        # called inside user.writing(), after anything the subclass keeps for the new entries is written
+        replaced = []
+        entries = []
+        with open(user.file(user.records_name), 'ab') as records:
+            for ordinal, chunk in enumerate(chunks):
+                record = json.dumps({'full_url': full_url, 'title': title, 'chunk': chunk}).encode('utf-8') + b'\n'
+                offset = records.tell()
+                records.write(record)
+                key = chunk_key(url_id, ordinal)
+                if key in user.key_entries:
+                    replaced.append(user.key_entries[key])
+                entries.append((key, url_id.bytes, offset, len(record), 1))
+        with open(user.file(user.entries_name), 'r+b' if user.n else 'wb') as f:
+            self._kill(f, replaced)
+            # drop anything a crashed writer left past the last complete entry
+            f.truncate(user.n * ENTRY_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.array(entries, dtype=ENTRY_DTYPE).tobytes())
+        user.refresh()
+
+    @staticmethod
+    def _kill(f, entries: Iterable[int]) -> None:
+        for entry in entries:
+            f.seek(entry * ENTRY_DTYPE.itemsize + ENTRY_DTYPE.fields['live'][1])
+            f.write(b'\0')
+
+    def remove(self, user_id: UUID, chunk_ids: Iterable[Tuple[UUID, int]]) -> None:
+        """Removes (url_id, ordinal) chunks"""
+        self._remove_keys(user_id, {chunk_key(url_id, ordinal) for url_id, ordinal in chunk_ids})
+
+    def _remove_keys(self, user_id: UUID, keys: Iterable[int]) -> None:
+        user = self._user(user_id)
+        with user.writing():
+            if not user.n:
+                return
+            with open(user.file(user.entries_name), 'r+b') as f:
+                self._kill(f, [user.key_entries[key] for key in keys if key in user.key_entries])
+
+    def _stale_pages(self, db: DB, user_id: UUID, local: Set[int], current: Set[int]) -> Iterable[list]:
+        """
+        The rows, in ordinal order, of each page with a chunk missing from `local`.  Adds the key of
+        every chunk in the database to `current` as it goes.
+        """
+        raise NotImplementedError
+
+    def _add_page(self, user_id: UUID, rows: list) -> None:
+        raise NotImplementedError
+
+    def _synced(self, user_id: UUID, n_added: int) -> None:
+        pass
+
+    def sync(self, db: DB, user_id: UUID) -> Tuple[int, int]:
+        """
+        Copies the user's chunks that are missing or out of date from the database, and removes
+        those that are no longer there.  Returns (added, removed).
+        """
+        user = self._user(user_id)
+        with user.lock:
+            user.refresh()
+            local = user.live_keys()
+        current = set()
+        n_added = 0
+        for rows in self._stale_pages(db, user_id, local, current):
+            self._add_page(user_id, rows)
+            n_added += len(rows)
+        removed = local - current
+        if removed:
+            self._remove_keys(user_id, removed)
+        self._synced(user_id, n_added)
+        return n_added, len(removed)
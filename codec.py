@@ -0,0 +1,131 @@
+import gzip
+import os
+import struct
+import threading
+from typing import Dict, List
+
+import zstandard
+
+# Compressed blobs (archived requests, formatted snapshots) start with a version byte saying how
+# the rest was compressed.  Blobs from before this module are plain gzip, and are recognized by
+# the gzip magic number, which never collides with a version byte.
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD = 1
+_ZSTD_DICT = 2  # followed by the uint32 id of the dictionary
+
+# Trained dictionaries, one per kind of data: 'raw' for archived requests, 'html' for formatted
+# snapshots.  If a dictionary file is missing, that kind is compressed without one.  Files are
+# named <kind>.<generation>.<dict_id>.dict; the highest generation of a kind is used to compress,
+# and older ones are kept to decompress what they compressed.
+dictionary_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codec_dicts')
+_LEVELS = {'raw': 3, 'html': 9}
+
+_dicts_by_kind: Dict[str, zstandard.ZstdCompressionDict] = {}
+_dicts_by_id: Dict[int, zstandard.ZstdCompressionDict] = {}
+_dicts_loaded = False
+_load_lock = threading.Lock()
+_local = threading.local()
+
+
+def _parse_name(fname: str):
+    """(kind, generation) for a dictionary file named <kind>.<generation>.<dict_id>.dict, else None"""
+    parts = fname.split('.')
+    if parts[-1] != 'dict':
+        return None
+    if len(parts) == 3:
+        # named <kind>.<dict_id>.dict, before generations were added
+        return parts[0], 0
+    if len(parts) != 4 or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1])
+
+
+def _load_dictionaries(reload: bool = False) -> None:
+    global _dicts_loaded
+    if _dicts_loaded and not reload:
+        return
+    with _load_lock:
+        if _dicts_loaded and not reload:
+            return
+        generations = {}
+        by_kind = {}
+        if os.path.isdir(dictionary_dir):
+            for fname in os.listdir(dictionary_dir):
+                parsed = _parse_name(fname)
+                if parsed is None:
+                    continue
+                kind, generation = parsed
+                with open(os.path.join(dictionary_dir, fname), 'rb') as f:
+                    d = zstandard.ZstdCompressionDict(f.read())
+                _dicts_by_id[d.dict_id()] = d
+                # every dictionary can decompress, but only the highest generation of each kind compresses
+                if generation >= generations.get(kind, -1):
+                    generations[kind] = generation
+                    by_kind[kind] = d
+        _dicts_by_kind.update(by_kind)
+        _dicts_loaded = True
+
+
+def _compressor(kind: str):
+    """A (thread-local, since they aren't thread-safe) compressor for the kind, and its dictionary"""
+    _load_dictionaries()
+    compressors = getattr(_local, 'compressors', None)
+    if compressors is None:
+        compressors = _local.compressors = {}
+    d = _dicts_by_kind.get(kind)
+    # a reload may have brought in a newer generation
+    if kind not in compressors or compressors[kind][1] is not d:
+        level = _LEVELS.get(kind, 3)
+        compressors[kind] = (zstandard.ZstdCompressor(level=level, dict_data=d) if d
+                             else zstandard.ZstdCompressor(level=level), d)
+    return compressors[kind]
+
+
+def compress(data: bytes, kind: str = 'raw') -> bytes:
+    compressor, d = _compressor(kind)
+    if d is None:
+        return bytes([_ZSTD]) + compressor.compress(data)
+    return bytes([_ZSTD_DICT]) + struct.pack('<I', d.dict_id()) + compressor.compress(data)
+
+
+def decompress(blob: bytes) -> bytes:
+    if blob[:2] == _GZIP_MAGIC:
+        return gzip.decompress(blob)
+    version = blob[0]
+    if version == _ZSTD:
+        return zstandard.ZstdDecompressor().decompress(blob[1:])
+    if version == _ZSTD_DICT:
+        _load_dictionaries()
+        dict_id, = struct.unpack_from('<I', blob, 1)
+        if dict_id not in _dicts_by_id:
+            # dictionaries are loaded once per process, so one deployed since then (by a newer
+            # server that already compresses with it) is only seen by looking again
+            _load_dictionaries(reload=True)
+        if dict_id not in _dicts_by_id:
+            raise ValueError(f'Compression dictionary {dict_id} not found in {dictionary_dir}')
+        return zstandard.ZstdDecompressor(dict_data=_dicts_by_id[dict_id]).decompress(blob[5:])
+    raise ValueError(f'Unknown compression version {version}')
+
+
+def is_current(blob: bytes, kind: str) -> bool:
+    """True if blob is already compressed the way compress() would do it now"""
+    _, d = _compressor(kind)
+    if d is None:
+        return blob[:1] == bytes([_ZSTD])
+    return blob[:5] == bytes([_ZSTD_DICT]) + struct.pack('<I', d.dict_id())
+
+
+def train_dictionary(samples: List[bytes], kind: str, size: int = 112_640) -> str:
+    """
+    Trains a dictionary for the kind from uncompressed samples and saves it, one generation after
+    the newest already there, so it replaces that one for compression.  Returns its path.
+    """
+    d = zstandard.train_dictionary(size, samples)
+    os.makedirs(dictionary_dir, exist_ok=True)
+    generations = [parsed[1] for parsed in map(_parse_name, os.listdir(dictionary_dir))
+                   if parsed and parsed[0] == kind]
+    generation = max(generations, default=0) + 1
+    path = os.path.join(dictionary_dir, f'{kind}.{generation}.{d.dict_id()}.dict')
+    with open(path, 'wb') as f:
+        f.write(d.as_bytes())
+    return path
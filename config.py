@@ -6,6 +6,8 @@ from cassandra.auth import PlainTextAuthProvider
 from cassandra.cluster import Cluster
 
 from db import DB
+from mirror import VectorMirror
+from lexical import LexicalIndex
 
 
 # Load secret keys into env vars
@@ -39,6 +41,14 @@ def _get_astra_bundle_url(dbid, token):
 
 
 # Configure DB for astra or localhost
+# BUCKETED_TABLES partitions pages and chunks by month; see scripts/migrate_buckets.py
+_bucketed = bool(os.environ.get('BUCKETED_TABLES'))
+# LEGACY_CHUNKS keeps writing (and searching) the old text-keyed chunk table until
+# scripts/backfill_chunks.py has copied it to saved_page_chunks
+_legacy_chunks = bool(os.environ.get('LEGACY_CHUNKS'))
+if _bucketed and _legacy_chunks:
+    raise Exception('BUCKETED_TABLES and LEGACY_CHUNKS cannot both be set: the legacy chunk table is not bucketed. '
+                    'Run scripts/backfill_chunks.py and unset LEGACY_CHUNKS before scripts/migrate_buckets.py')
 _astra_token = os.environ.get('ASTRA_TOKEN')
 _astra_db_id = os.environ.get('ASTRA_DB_ID')
 if _astra_token:
@@ -55,12 +65,28 @@ if _astra_token:
     }
     _auth_provider = PlainTextAuthProvider('token', _astra_token)
     cluster = Cluster(cloud=cloud_config, auth_provider=_auth_provider)
-    db = DB(cluster)
+    db = DB(cluster, bucketed=_bucketed, legacy_chunks=_legacy_chunks)
     tr_data_dir = '/home/ubuntu/trserver/data'
 else:
     print('Connecting to local Cassandra')
-    db = DB(Cluster())
+    db = DB(Cluster(), bucketed=_bucketed, legacy_chunks=_legacy_chunks)
 
 # FIXME this literally only works on my machine
 if os.path.exists('/home/jonathan'):
     tr_data_dir = '/home/jonathan/Projects/trserver/data'
+
+# Optional local copy of the chunk embeddings for search, enabled by setting MIRROR_DIR (or with a
+# secrets/mirror_dir file).  Run scripts/sync_mirror.py to fill it in.
+_mirror_dir = os.environ.get('MIRROR_DIR')
+mirror = VectorMirror(_mirror_dir) if _mirror_dir else None
+
+# Optional local BM25 index, fused with the vector search results, enabled by setting LEXICAL_DIR.
+# Run scripts/sync_lexical.py to index pages saved before it was enabled.
+_lexical_dir = os.environ.get('LEXICAL_DIR')
+lexical = LexicalIndex(_lexical_dir) if _lexical_dir else None
+
+# Optional background formatting of newly saved pages, enabled by setting PREFORMAT_TOKENS_PER_HOUR
+# to the OpenAI tokens an hour the whole deployment may spend on it.  Each worker process formats
+# independently, so each gets an equal share; WEB_CONCURRENCY is uvicorn's number of workers.
+_n_workers = int(os.environ.get('WEB_CONCURRENCY') or 1)
+preformat_tokens_per_hour = int(os.environ.get('PREFORMAT_TOKENS_PER_HOUR') or 0) // _n_workers
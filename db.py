@@ -1,12 +1,97 @@
+import asyncio
+import heapq
+import random
+import threading
 import time
+import traceback
 from collections import defaultdict
-from datetime import datetime
-from typing import Dict, List, Tuple, Union, Any, Optional
+from datetime import datetime, timedelta
+from types import SimpleNamespace as SN
+from itertools import chain
+from typing import Dict, Iterable, List, Tuple, Union, Any, Optional
 from urllib.parse import urlparse
 from uuid import uuid4, uuid1, UUID
 
-from cassandra.cluster import Cluster
-from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.cluster import Cluster, Session, ResponseFuture, ResultSet
+from cassandra.policies import HostStateListener
+from cassandra.query import BatchStatement, BatchType, PreparedStatement
+from cassandra.util import min_uuid_from_time, unix_time_from_uuid1
+import numpy as np
+
+import fingerprint as fp
+from band_index import BandIndex
+
+
+class StatementRegistry:
+    """
+    Prepares each named CQL statement once and hands out the cached PreparedStatement.
+
+    Statements are prepared eagerly by prepare_all() when the connection is set up.  invalidate()
+    drops the cache (after a reconnect or a schema change) so the next lookup re-prepares.
+    """
+    def __init__(self, session: Session) -> None:
+        self.session = session
+        self.hits = 0
+        self.misses = 0
+        self._cql: Dict[str, str] = {}
+        self._prepared: Dict[str, PreparedStatement] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, cql: str) -> None:
+        self._cql[name] = cql
+
+    def prepare_all(self) -> None:
+        for name in self._cql:
+            self[name]
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._prepared.clear()
+
+    def __getitem__(self, name: str) -> PreparedStatement:
+        statement = self._prepared.get(name)
+        if statement is not None:
+            self.hits += 1
+            return statement
+        with self._lock:
+            statement = self._prepared.get(name)
+            if statement is None:
+                self.misses += 1
+                statement = self.session.prepare(self._cql[name])
+                self._prepared[name] = statement
+            else:
+                self.hits += 1
+            return statement
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'prepared': len(self._prepared)}
+
+
+def _resolve(future: asyncio.Future, response_future: ResponseFuture) -> None:
+    if future.cancelled():
+        return
+    try:
+        future.set_result(response_future.result())
+    except Exception as e:
+        future.set_exception(e)
+
+
+class _ReprepareOnReconnect(HostStateListener):
+    """Invalidates the registry when a node comes (back) up, so statements are re-prepared against it."""
+    def __init__(self, statements: StatementRegistry) -> None:
+        self.statements = statements
+
+    def on_up(self, host) -> None:
+        self.statements.invalidate()
+
+    def on_add(self, host) -> None:
+        self.statements.invalidate()
+
+    def on_down(self, host) -> None:
+        pass
+
+    def on_remove(self, host) -> None:
+        pass
 
 # data model:
 # we have urls, paths, and chunks.
@@ -15,11 +100,104 @@ from cassandra.concurrent import execute_concurrent_with_args
 # recent version of the page in the paths table.  If it's the same, we don't save the page.
 # This allows us to accommodate urls that only differ by query string, without saving
 # multiple copies of the same page.
+# near-duplicate detection compares the raw minhashes of this many ANN candidates
+N_DEDUP_CANDIDATES = 10
+DUPLICATE_THRESHOLD = 0.95
+# a page at the duplicate threshold shares ~0.95**4 of its bands, so pages sharing fewer
+# than half of them aren't worth comparing
+MIN_BAND_MATCHES = 32
+# a page's url_id is assigned when it is received, but it is written after it has been embedded,
+# so refreshing the band index re-reads pages this much older than the newest one it has seen
+RECENT_PAGE_SLACK_SECONDS = 600
+
+# by default, a page of search results is this many URLs, with up to this many of the best chunks from each
+N_RESULTS = 10
+N_RESULTS_PER_PAGE = 3
+# search ranks URLs by the closest this many chunks, by default and at most (the ANN query limit)
+SEARCH_DEPTH = 50
+MAX_SEARCH_DEPTH = 1000
+# candidate chunks are streamed from the database this many at a time
+SEARCH_FETCH_SIZE = 100
+# with bucketed tables, each bucket is first searched for this many times its share of the depth
+BUCKET_SEARCH_OVERSAMPLE = 2
+
+# a page's chunks are written in unlogged batches of about this many bytes, under the default
+# batch_size_fail_threshold of 50KB
+CHUNK_BATCH_BYTES = 40_000
+# failed writes are retried this many times in all, after a random delay of up to
+# WRITE_RETRY_DELAY seconds, doubling each time
+WRITE_ATTEMPTS = 6
+WRITE_RETRY_DELAY = 0.5
+
+
+def aggregate_by_url(rows,
+                     n_results: int = N_RESULTS,
+                     chunks_per_url: int = N_RESULTS_PER_PAGE,
+                     offset: int = 0) -> List[Dict[str, Any]]:
+    """
+    Groups chunk search results (best first, with full_url, title, chunk, url_id and score) by
+    URL, ranks the URLs by their total score, and returns n_results of them starting at offset
+    """
+    url_dict = defaultdict(lambda: {'chunks': [], 'title': None, 'url_id': None, 'total_score': 0})
+
+    for row in rows:
+        doc = url_dict[row.full_url]
+        doc['total_score'] += row.score
+        if len(doc['chunks']) < chunks_per_url:  # only keep the top chunks for each URL
+            doc['chunks'].append((row.chunk, row.score))
+            doc['title'] = row.title
+            doc['url_id'] = row.url_id
+
+    # only the URLs up to the end of the requested page need to be ordered
+    L = heapq.nlargest(offset + n_results,
+                       ({'full_url': url, **info} for url, info in url_dict.items()),
+                       key=lambda x: x['total_score'])
+    return L[offset:]
+
+
+_UUID_EPOCH = datetime(1582, 10, 15)
+
+def month_of(t: Union[UUID, datetime]) -> int:
+    """The yyyymm bucket of a timeuuid or a datetime"""
+    if isinstance(t, UUID):
+        t = _UUID_EPOCH + timedelta(microseconds=t.time // 10)
+    return t.year * 100 + t.month
+
+
+# with bucketed tables, how long a user's list of buckets is trusted before it is read again
+BUCKET_CACHE_SECONDS = 60
+
+
 class DB:
-    def __init__(self, cluster: Cluster) -> None:
+    """
+    With bucketed=True, pages and chunks are partitioned by (user_id, month) instead of by user_id
+    alone, so that no partition grows without bound, and the months each user has saved pages in
+    are listed in the user_buckets table.  Reads that span a user's whole history fan out to every
+    bucket; scripts/migrate_buckets.py copies the unbucketed tables to the bucketed ones.
+
+    Chunks are keyed by (url_id, ordinal) within the partition.  The legacy chunk tables were keyed
+    by the chunk text, so identical chunks from different pages overwrote each other; with
+    legacy_chunks=True, chunks are written to both and searches still read the legacy table, until
+    scripts/backfill_chunks.py has copied it over.  The legacy table is never bucketed, so
+    legacy_chunks can't be combined with bucketed.
+    """
+    def __init__(self, cluster: Cluster, bucketed: bool = False, legacy_chunks: bool = False) -> None:
+        if bucketed and legacy_chunks:
+            raise ValueError("legacy_chunks needs the unbucketed tables; run scripts/backfill_chunks.py before migrating")
         self.keyspace = "total_recall"
-        self.table_chunks = "saved_chunks"
-        self.table_pages = "saved_pages"
+        self.bucketed = bucketed
+        self.legacy_chunks = legacy_chunks
+        self.table_chunks = "saved_page_chunks_by_month" if bucketed else "saved_page_chunks"
+        # legacy chunks were only ever written unbucketed
+        self.table_legacy_chunks = "saved_chunks"
+        self.table_pages = "saved_pages_by_month" if bucketed else "saved_pages"
+        self.table_buckets = "user_buckets"
+        partition_key = "(user_id, month)" if bucketed else "user_id"
+        month_column = "month int," if bucketed else ""
+        # CQL fragments for the partition key; _pk() makes the matching parameters
+        self._partition = "user_id = ? AND month = ?" if bucketed else "user_id = ?"
+        self._partition_columns = "user_id, month" if bucketed else "user_id"
+        self._partition_markers = "?, ?" if bucketed else "?"
         fingerprint_index_name = f"{self.table_pages}_fingerprint_idx" # update this when index column name changes
         embedding_index_name = f"{self.table_chunks}_embedding_idx" # update this when index column name changes
         # TODO add chunks_embedding_column as a constant so it can change easier
@@ -40,15 +218,21 @@ class DB:
             f"""
             CREATE TABLE IF NOT EXISTS {self.keyspace}.{self.table_pages} (
             user_id uuid,
+            {month_column}
             url_id timeuuid,
             full_url text,
             title text,
             text_content text,
             content_gz blob,
             fingerprint vector<float, 2048>,
-            PRIMARY KEY (user_id, url_id));
+            minhashes blob,
+            PRIMARY KEY ({partition_key}, url_id));
             """
         )
+        # raw minhashes were added after the table was created, so older tables need to be altered
+        pages_metadata = self.cluster.metadata.keyspaces[self.keyspace].tables[self.table_pages]
+        if 'minhashes' not in pages_metadata.columns:
+            self.session.execute(f"ALTER TABLE {self.keyspace}.{self.table_pages} ADD minhashes blob")
         # fingerprint index
         self.session.execute(
             f"""
@@ -63,12 +247,14 @@ class DB:
             f"""
             CREATE TABLE IF NOT EXISTS {self.keyspace}.{self.table_chunks} (
             user_id uuid,
+            {month_column}
             url_id timeuuid,
+            ordinal int,
             full_url text,
             title text,
             chunk text,
             embedding_g4 vector<float, 768>,
-            PRIMARY KEY (user_id, chunk));
+            PRIMARY KEY ({partition_key}, url_id, ordinal));
             """
         )
         # Embedding index
@@ -80,139 +266,569 @@ class DB:
             """
         )
 
-    def upsert_chunks(self,
-                      user_id: uuid4,
-                      full_url: str,
-                      title: str,
-                      text_content: str,
-                      fingerprint: List[float],
-                      chunks: List[Tuple[str, List[float]]],
-                      url_uuid: Optional[uuid1]) -> None:
-        st_pages = self.session.prepare(
-            f"""
-            INSERT INTO {self.keyspace}.{self.table_pages}
-            (user_id, url_id, full_url, title, text_content, fingerprint)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """
-        )
-        self.session.execute(st_pages, (user_id, url_uuid, full_url, title, text_content, fingerprint))
+        if bucketed:
+            self.session.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {self.keyspace}.{self.table_buckets} (
+                user_id uuid,
+                month int,
+                PRIMARY KEY (user_id, month))
+                WITH CLUSTERING ORDER BY (month DESC);
+                """
+            )
+        self._buckets_cache: Dict[UUID, Tuple[float, List[int]]] = {}
+
+        self.band_index = BandIndex()
+        self._band_loads = set()
+        self._band_loads_lock = threading.Lock()
+
+        self.statements = StatementRegistry(self.session)
+        self._register_statements()
+        self.statements.prepare_all()
+        self.cluster.register_listener(_ReprepareOnReconnect(self.statements))
+
+    def _register_statements(self) -> None:
+        register = self.statements.register
+        register('insert_page',
+                 f"""
+                 INSERT INTO {self.keyspace}.{self.table_pages}
+                 ({self._partition_columns}, url_id, full_url, title, text_content, fingerprint, minhashes)
+                 VALUES ({self._partition_markers}, ?, ?, ?, ?, ?, ?)
+                 """)
+        register('insert_chunk',
+                 f"""
+                 INSERT INTO {self.keyspace}.{self.table_chunks}
+                 ({self._partition_columns}, url_id, ordinal, full_url, title, chunk, embedding_g4)
+                 VALUES ({self._partition_markers}, ?, ?, ?, ?, ?, ?)
+                 """)
+        register('recent_urls',
+                 f"""
+                 SELECT full_url, title, url_id 
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} 
+                 ORDER BY url_id DESC
+                 LIMIT ?
+                 """)
+        register('recent_urls_before',
+                 f"""
+                 SELECT full_url, title, url_id 
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} AND url_id < minTimeuuid(?)
+                 ORDER BY url_id DESC
+                 LIMIT ?
+                 """)
+        register('search',
+                 f"""
+                 SELECT full_url, title, chunk, url_id, similarity_dot_product(embedding_g4, ?) as score
+                 FROM {self.keyspace}.{self.table_legacy_chunks if self.legacy_chunks else self.table_chunks} 
+                 WHERE {self._partition} 
+                 ORDER BY embedding_g4 ANN OF ? LIMIT ?
+                 """)
+        register('load_snapshot',
+                 f"""
+                 SELECT full_url, title, text_content, content_gz
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} AND url_id = ?
+                 """)
+        register('save_formatting',
+                 f"""
+                 UPDATE {self.keyspace}.{self.table_pages}
+                 SET content_gz = ?
+                 WHERE {self._partition} AND url_id = ?
+                 """)
+        register('similar_page',
+                 f"""
+                 SELECT minhashes, similarity_dot_product(fingerprint, ?) AS score
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} 
+                 ORDER BY fingerprint ANN OF ? LIMIT {N_DEDUP_CANDIDATES}
+                 """)
+        register('all_page_minhashes',
+                 f"""
+                 SELECT url_id, minhashes
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} 
+                 """)
+        register('page_minhashes_since',
+                 f"""
+                 SELECT url_id, minhashes
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} AND url_id > ?
+                 """)
+        register('page_minhashes',
+                 f"""
+                 SELECT url_id, minhashes
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} AND url_id IN ?
+                 """)
+        register('page_fingerprints',
+                 f"""
+                 SELECT url_id, fingerprint
+                 FROM {self.keyspace}.{self.table_pages} 
+                 WHERE {self._partition} AND url_id IN ?
+                 """)
+        register('chunk_ids',
+                 f"""
+                 SELECT url_id, ordinal
+                 FROM {self.keyspace}.{self.table_chunks} 
+                 WHERE {self._partition} 
+                 """)
+        register('chunk_texts',
+                 f"""
+                 SELECT url_id, ordinal, full_url, title, chunk
+                 FROM {self.keyspace}.{self.table_chunks} 
+                 WHERE {self._partition} 
+                 """)
+        register('load_chunks',
+                 f"""
+                 SELECT url_id, ordinal, full_url, title, chunk, embedding_g4
+                 FROM {self.keyspace}.{self.table_chunks} 
+                 WHERE {self._partition} AND url_id IN ?
+                 """)
+
+        if self.legacy_chunks:
+            register('insert_legacy_chunk',
+                     f"""
+                     INSERT INTO {self.keyspace}.{self.table_legacy_chunks}
+                     ({self._partition_columns}, url_id, full_url, title, chunk, embedding_g4)
+                     VALUES ({self._partition_markers}, ?, ?, ?, ?, ?)
+                     """)
+            register('legacy_chunk_versions',
+                     f"""
+                     SELECT chunk, url_id
+                     FROM {self.keyspace}.{self.table_legacy_chunks}
+                     WHERE {self._partition}
+                     """)
+            register('legacy_load_chunks',
+                     f"""
+                     SELECT chunk, embedding_g4
+                     FROM {self.keyspace}.{self.table_legacy_chunks}
+                     WHERE {self._partition} AND chunk IN ?
+                     """)
+
+        if self.bucketed:
+            register('buckets',
+                     f"""
+                     SELECT month
+                     FROM {self.keyspace}.{self.table_buckets}
+                     WHERE user_id = ?
+                     """)
+            register('add_bucket',
+                     f"""
+                     INSERT INTO {self.keyspace}.{self.table_buckets} (user_id, month)
+                     VALUES (?, ?)
+                     """)
+
+    def _pk(self, user_id: UUID, month: Optional[int]) -> tuple:
+        return (user_id, month) if self.bucketed else (user_id,)
+
+
+    def _page_pk(self, user_id: UUID, url_id: UUID) -> tuple:
+        return self._pk(user_id, month_of(url_id) if self.bucketed else None)
+
+
+    def _buckets(self, user_id: UUID) -> List[Optional[int]]:
+        """The months the user has pages in, newest first ([None] if the tables aren't bucketed)"""
+        if not self.bucketed:
+            return [None]
+        months = self._cached_buckets(user_id)
+        if months is None:
+            months = self._cache_buckets(user_id, self.session.execute(self.statements['buckets'], (user_id,)))
+        return months
+
+
+    async def _buckets_async(self, user_id: UUID) -> List[Optional[int]]:
+        """_buckets without blocking the event loop"""
+        if not self.bucketed:
+            return [None]
+        months = self._cached_buckets(user_id)
+        if months is None:
+            months = self._cache_buckets(user_id, await self.execute_async(self.statements['buckets'], (user_id,)))
+        return months
+
+
+    def _cached_buckets(self, user_id: UUID) -> Optional[List[int]]:
+        cached = self._buckets_cache.get(user_id)
+        if cached is None or time.monotonic() - cached[0] > BUCKET_CACHE_SECONDS:
+            return None
+        return cached[1]
+
+
+    def _cache_buckets(self, user_id: UUID, rows) -> List[int]:
+        months = [row.month for row in rows]
+        self._buckets_cache[user_id] = (time.monotonic(), months)
+        return months
+
+
+    async def _add_bucket_async(self, user_id: UUID, url_id: UUID) -> None:
+        """Lists the page's month among the user's buckets, if it isn't known to be there already"""
+        if not self.bucketed:
+            return
+        month = month_of(url_id)
+        if month in await self._buckets_async(user_id):
+            return
+        await self.execute_async(self.statements['add_bucket'], (user_id, month))
+        # cached only once the write has succeeded, so a failed one is tried again by the next save
+        cached = self._buckets_cache.get(user_id)
+        if cached is not None and month not in cached[1]:
+            self._buckets_cache[user_id] = (cached[0], sorted(cached[1] + [month], reverse=True))
+
+
+    def _fan_out(self, statements: list) -> List[ResultSet]:
+        """Runs (statement, parameters) pairs, one per bucket, concurrently"""
+        futures = [self.session.execute_async(statement, parameters) for statement, parameters in statements]
+        return [future.result() for future in futures]
+
+
+    def _by_bucket(self, user_id: UUID, url_ids: List[UUID]) -> List[Tuple[tuple, List[UUID]]]:
+        """(partition key parameters, url_ids) for each bucket the url_ids fall in"""
+        if not self.bucketed:
+            return [(self._pk(user_id, None), url_ids)]
+        groups = defaultdict(list)
+        for url_id in url_ids:
+            groups[month_of(url_id)].append(url_id)
+        return [(self._pk(user_id, month), ids) for month, ids in groups.items()]
 
-        st_chunks = self.session.prepare(
-            f"""
-            INSERT INTO {self.keyspace}.{self.table_chunks}
-            (user_id, url_id, full_url, title, chunk, embedding_g4)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """
-        )
-        denormalized_chunks = [(user_id, url_uuid, full_url, title, chunk, embedding)
-                               for chunk, embedding in chunks]
-        backoff = 0.5
-        # print(f"Inserting {denormalized_chunks}")
-        while denormalized_chunks and backoff < 60:
-            results = execute_concurrent_with_args(self.session, st_chunks, denormalized_chunks,
-                                                   concurrency=16, raise_on_first_error=True)
-            denormalized_chunks = [chunk for chunk, (success, _)
-                                   in zip(denormalized_chunks, results) if not success]
-            time.sleep(backoff)
-            backoff *= 2
-        if denormalized_chunks:
-            raise Exception(f"Failed to insert {len(denormalized_chunks)} chunks")
+
+    async def upsert_chunks_async(self,
+                                  user_id: uuid4,
+                                  full_url: str,
+                                  title: str,
+                                  text_content: str,
+                                  fingerprint: List[float],
+                                  minhashes: np.ndarray,
+                                  chunks: List[Tuple[str, List[float]]],
+                                  url_uuid: Optional[uuid1]) -> None:
+        # the bucket is listed before anything is written to it, so readers never miss a page
+        await self._add_bucket_async(user_id, url_uuid)
+        # reserved before writing, so concurrent saves of the same page see it; released if the
+        # writes fail, so a page that was never saved doesn't make later copies look like duplicates
+        self.reserve_page(user_id, url_uuid, minhashes)
+        try:
+            await self._execute_with_retries_async(
+                self._page_writes(user_id, full_url, title, text_content, fingerprint, minhashes, chunks, url_uuid),
+                full_url)
+        except Exception:
+            self.release_page(user_id, url_uuid)
+            raise
+
+
+    async def _execute_with_retries_async(self, writes: List[Tuple[Any, Optional[tuple]]], full_url: str) -> None:
+        semaphore = asyncio.Semaphore(16)
+        async def execute(statement, params):
+            async with semaphore:
+                await self.execute_async(statement, params)
+
+        delay = WRITE_RETRY_DELAY
+        for attempt in range(WRITE_ATTEMPTS):
+            results = await asyncio.gather(*[execute(*write) for write in writes], return_exceptions=True)
+            failures = [(write, result) for write, result in zip(writes, results) if isinstance(result, Exception)]
+            if not failures:
+                return
+            writes = [write for write, _ in failures]
+            if attempt < WRITE_ATTEMPTS - 1:
+                await asyncio.sleep(random.uniform(0, delay))
+                delay *= 2
+        raise Exception(f"Failed to write {len(failures)} statements for {full_url}: {failures[0][1]}")
+
+
+    def _page_writes(self,
+                     user_id: uuid4,
+                     full_url: str,
+                     title: str,
+                     text_content: str,
+                     fingerprint: List[float],
+                     minhashes: np.ndarray,
+                     chunks: List[Tuple[str, List[float]]],
+                     url_uuid: uuid1) -> List[Tuple[Any, Optional[tuple]]]:
+        """
+        (statement, parameters) for the page row and its chunks, which are independent of each
+        other and can all be sent at once.  A page's chunks all live in one partition, so they go
+        in unlogged batches: one round trip per batch, without the batch log a multi-partition
+        batch would need.
+        """
+        pk = self._page_pk(user_id, url_uuid)
+        writes = [(self.statements['insert_page'],
+                   (*pk, url_uuid, full_url, title, text_content, fingerprint, fp.pack_minhashes(minhashes)))]
+        chunks = list(chunks)
+        writes.extend(self._batches([(self.statements['insert_chunk'],
+                                      (*pk, url_uuid, ordinal, full_url, title, chunk, embedding))
+                                     for ordinal, (chunk, embedding) in enumerate(chunks)]))
+        if self.legacy_chunks:
+            # a separate table is a separate partition, so its copies are batched separately
+            writes.extend(self._batches([(self.statements['insert_legacy_chunk'],
+                                          (*pk, url_uuid, full_url, title, chunk, embedding))
+                                         for chunk, embedding in chunks]))
+        return writes
+
+    @staticmethod
+    def _batches(inserts: List[Tuple[PreparedStatement, tuple]]) -> List[Tuple[BatchStatement, None]]:
+        """Groups inserts into one partition into unlogged batches of about CHUNK_BATCH_BYTES"""
+        batches = []
+        batch, size = None, 0
+        for statement, params in inserts:
+            # the embedding and chunk text (the last two parameters) dominate the size of a row
+            row_size = 4 * len(params[-1]) + len(params[-2].encode('utf-8'))
+            if batch is None or size and size + row_size > CHUNK_BATCH_BYTES:
+                batch, size = BatchStatement(batch_type=BatchType.UNLOGGED), 0
+                batches.append((batch, None))
+            batch.add(statement, params)
+            size += row_size
+        return batches
+
+    def execute_async(self, statement, parameters=None) -> asyncio.Future:
+        """Runs a statement without blocking the event loop; the returned future resolves to the ResultSet."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        response_future = self.session.execute_async(statement, parameters)
+        response_future.add_callbacks(
+            lambda _: loop.call_soon_threadsafe(_resolve, future, response_future),
+            lambda _: loop.call_soon_threadsafe(_resolve, future, response_future))
+        return future
 
 
     def recent_urls(self, user_id: uuid4, saved_before: Optional[datetime], limit: int) -> List[Dict[str, Union[str, datetime, UUID]]]:
-        if saved_before:
-            cql = f"""
-                  SELECT full_url, title, url_id 
-                  FROM {self.keyspace}.{self.table_pages} 
-                  WHERE user_id = ? AND url_id < minTimeuuid(?)
-                  ORDER BY url_id DESC
-                  LIMIT ?
-                  """
-        else:
-            cql = f"""
-                  SELECT full_url, title, url_id 
-                  FROM {self.keyspace}.{self.table_pages} 
-                  WHERE user_id = ? 
-                  ORDER BY url_id DESC
-                  LIMIT ?
-                  """
-        query = self.session.prepare(
-            cql
-        )
-        if saved_before:
-            results = self.session.execute(query, (user_id, saved_before, limit))
-        else:
-            results = self.session.execute(query, (user_id, limit))
+        # newest bucket first, and only as many as it takes to fill the page
+        results = []
+        for month in self._buckets(user_id):
+            if month is not None and saved_before and month > month_of(saved_before):
+                continue
+            pk = self._pk(user_id, month)
+            if saved_before:
+                rows = self.session.execute(self.statements['recent_urls_before'], (*pk, saved_before, limit - len(results)))
+            else:
+                rows = self.session.execute(self.statements['recent_urls'], (*pk, limit - len(results)))
+            results.extend(rows)
+            if len(results) >= limit:
+                break
         return [{k: getattr(row, k) for k in ['full_url', 'title', 'url_id']} for row in results]
 
 
-    def search(self, user_id: uuid4, vector: List[float]) -> List[Dict[str, Union[Tuple[str, float, UUID]]]]:
-        N_RESULTS = 10
-        N_RESULTS_PER_PAGE = 3
-        query = self.session.prepare(
-            f"""
-            SELECT full_url, title, chunk, url_id, similarity_dot_product(embedding_g4, ?) as score
-            FROM {self.keyspace}.{self.table_chunks} 
-            WHERE user_id = ? 
-            ORDER BY embedding_g4 ANN OF ? LIMIT 50
-            """
-        )
-        result_set = self.session.execute(query, (vector, user_id, vector))
-        url_dict = defaultdict(lambda: {'chunks': [], 'title': None, 'url_id': None, 'total_score': 0})
+    def search(self,
+               user_id: uuid4,
+               vector: List[float],
+               n_results: int = N_RESULTS,
+               chunks_per_url: int = N_RESULTS_PER_PAGE,
+               depth: int = SEARCH_DEPTH,
+               offset: int = 0) -> List[Dict[str, Union[Tuple[str, float, UUID]]]]:
+        return aggregate_by_url(self.search_chunks(user_id, vector, depth), n_results, chunks_per_url, offset)
+
+
+    def search_chunks(self, user_id: uuid4, vector: List[float], depth: int = SEARCH_DEPTH):
+        """
+        The `depth` chunks closest to vector, best first, before aggregating them by URL.  With one
+        bucket, they are fetched a page at a time as the result is iterated.
+        """
+        depth = min(depth, MAX_SEARCH_DEPTH)
+        months = self._buckets(user_id)
+        if len(months) == 1:
+            return self._fan_out([self._search_statement(user_id, months[0], vector, depth)])[0]
 
-        for row in result_set:
-            doc = url_dict[row.full_url]
-            doc['total_score'] += row.score
-            if len(doc['chunks']) < N_RESULTS_PER_PAGE:  # only keep the top 3 chunks for each URL
-                doc['chunks'].append((row.chunk, row.score))
-                doc['title'] = row.title
-                doc['url_id'] = row.url_id
+        # Searching every bucket to the full depth would cost buckets x depth, so each bucket is
+        # searched for (a multiple of) its share of the depth first.  A bucket that filled its share with chunks
+        # scoring at least as well as the depth-th best overall may hold more of the best ones,
+        # so only those are searched again, to the full depth.
+        share = min(depth, BUCKET_SEARCH_OVERSAMPLE * -(-depth // len(months)))
+        result_sets = [list(rs) for rs in self._fan_out([self._search_statement(user_id, month, vector, share)
+                                                         for month in months])]
+        best = heapq.nlargest(depth, chain(*result_sets), key=lambda row: row.score)
+        cutoff = best[-1].score if len(best) == depth else float('-inf')
+        deeper = [i for i, rows in enumerate(result_sets)
+                  if share < depth and len(rows) == share and rows[-1].score >= cutoff]
+        if not deeper:
+            return best
+        deeper_sets = self._fan_out([self._search_statement(user_id, months[i], vector, depth) for i in deeper])
+        for i, rs in zip(deeper, deeper_sets):
+            result_sets[i] = rs
+        return heapq.nlargest(depth, chain(*result_sets), key=lambda row: row.score)
 
-        # Convert dictionary to list and sort by total score
-        L = [{'full_url': url, **info} for url, info in url_dict.items()]
-        return sorted(L, key=lambda x: x['total_score'], reverse=True)[:N_RESULTS]
+
+    def _search_statement(self, user_id: uuid4, month: Optional[int], vector: List[float], limit: int):
+        statement = self.statements['search'].bind((vector, *self._pk(user_id, month), vector, limit))
+        statement.fetch_size = SEARCH_FETCH_SIZE
+        return statement, None
 
 
     def load_snapshot(self, user_id: uuid4, url_id: uuid1) -> tuple[str, str, str, str]:
-        query = self.session.prepare(
-            f"""
-            SELECT full_url, title, text_content, content_gz
-            FROM {self.keyspace}.{self.table_pages} 
-            WHERE user_id = ? AND url_id = ?
-            """
-        )
-        return self.session.execute(query, (user_id, url_id)).one()
+        return self.session.execute(self.statements['load_snapshot'], (*self._page_pk(user_id, url_id), url_id)).one()
 
 
     def save_formatting(self, user_id: uuid4, url_id: uuid1, content_gz: str) -> None:
-        request = self.session.prepare(
-            f"""
-            UPDATE {self.keyspace}.{self.table_pages}
-            SET content_gz = ?
-            WHERE user_id = ? AND url_id = ?
-            """
-        )
-        self.session.execute(request, (content_gz, user_id, url_id))
+        self.session.execute(self.statements['save_formatting'], (content_gz, *self._page_pk(user_id, url_id), url_id))
+
+
+    def _all_buckets(self, name: str, user_id: UUID) -> Iterable:
+        """Rows of a statement that reads a whole partition, from each of the user's buckets in turn"""
+        for month in self._buckets(user_id):
+            yield from self.session.execute(self.statements[name], self._pk(user_id, month))
+
+
+    def chunk_ids(self, user_id: uuid4) -> Iterable[Tuple[UUID, int]]:
+        """(url_id, ordinal) of every chunk the user has saved"""
+        return ((row.url_id, row.ordinal) for row in self._all_buckets('chunk_ids', user_id))
+
+
+    def chunk_texts(self, user_id: uuid4):
+        """Every chunk the user has saved, without the embeddings, in (url_id, ordinal) order within each bucket"""
+        return self._all_buckets('chunk_texts', user_id)
+
+
+    def load_chunks(self, user_id: uuid4, url_ids: List[UUID]):
+        """Full rows, including embeddings, of every chunk of the given pages"""
+        for pk, bucket_ids in self._by_bucket(user_id, url_ids):
+            for start in range(0, len(bucket_ids), 100):
+                yield from self.session.execute(self.statements['load_chunks'], (*pk, bucket_ids[start:start + 100]))
+
+
+    def legacy_chunk_pages(self, user_id: uuid4) -> Dict[UUID, List[str]]:
+        """url_id -> chunks of the user's pages in the legacy chunk table (needs legacy_chunks=True)"""
+        pages = defaultdict(list)
+        for row in self._all_buckets('legacy_chunk_versions', user_id):
+            pages[row.url_id].append(row.chunk)
+        return pages
+
+
+    def load_legacy_chunks(self, user_id: uuid4, url_id: uuid1, chunks: List[str]) -> Dict[str, List[float]]:
+        """chunk -> embedding from the legacy chunk table (needs legacy_chunks=True)"""
+        embeddings = {}
+        pk = self._page_pk(user_id, url_id)
+        for start in range(0, len(chunks), 100):
+            rows = self.session.execute(self.statements['legacy_load_chunks'], (*pk, chunks[start:start + 100]))
+            embeddings.update((row.chunk, row.embedding_g4) for row in rows)
+        return embeddings
+
+
+    def user_ids(self) -> List[UUID]:
+        if self.bucketed:
+            rows = self.session.execute(f"SELECT DISTINCT user_id FROM {self.keyspace}.{self.table_buckets}")
+        else:
+            rows = self.session.execute(f"SELECT DISTINCT user_id FROM {self.keyspace}.{self.table_pages}")
+        return [row.user_id for row in rows]
 
 
     def _get_user_ids(self):
         return  self.session.execute(f"SELECT user_id FROM {self.keyspace}.{self.table_chunks}").all()
 
 
-    def similar_page_exists(self, user_id, fingerprint):
-        query = self.session.prepare(
-            f"""
-            SELECT similarity_dot_product(fingerprint, ?) 
-            FROM {self.keyspace}.{self.table_pages} 
-            WHERE user_id = ? 
-            ORDER BY fingerprint ANN OF ? LIMIT 1
-            """
-        )
-        rs = self.session.execute(query, (fingerprint, user_id, fingerprint))
-        if not rs.current_rows:
+    async def similar_page_exists_async(self, user_id, fingerprint, minhashes):
+        candidates = self._band_candidates(user_id, fingerprint)
+        if candidates is None:
+            result_sets = await asyncio.gather(*[
+                self.execute_async(self.statements['similar_page'], (fingerprint, *self._pk(user_id, month), fingerprint))
+                for month in await self._buckets_async(user_id)])
+            return self._is_similar(self._best_similar(result_sets), minhashes)
+        if not candidates:
             return False
-        # TODO it looks like our fingerprint encoding suffers from degraded accuracy
-        # as document lengths get longer -- you end up with more collisions, inflating similarity.
-        # We should probably use ANN to find the top N most similar documents, then do a comparison
-        # of the actual minhash values.
-        return rs.one()[0] >= 0.95
+        result_sets = await asyncio.gather(*[self.execute_async(self.statements['page_minhashes'], (*pk, url_ids))
+                                             for pk, url_ids in self._by_bucket(user_id, list(candidates))])
+        return self._is_similar(self._candidate_rows(candidates, chain(*result_sets)), minhashes)
+
+
+    def _refresh_since(self, user_id) -> Optional[UUID]:
+        """The url_id to read pages the band index may be missing from, or None for all of them"""
+        newest = self.band_index.newest_loaded(user_id)
+        if newest is None:
+            return None
+        return min_uuid_from_time(unix_time_from_uuid1(newest) - RECENT_PAGE_SLACK_SECONDS)
+
+
+    @staticmethod
+    def _best_similar(result_sets) -> list:
+        """The closest N_DEDUP_CANDIDATES pages across the ANN results of every bucket"""
+        return heapq.nlargest(N_DEDUP_CANDIDATES, chain(*result_sets), key=lambda row: row.score)
+
+
+    def _band_candidates(self, user_id, fingerprint) -> Optional[Dict[UUID, float]]:
+        """
+        Candidate url_id -> fingerprint similarity from the in-memory band index, or None if the
+        user's index isn't loaded yet (in which case it starts loading in the background).  Pages
+        saved by this process are in the index as soon as they are reserved; those saved by other
+        processes are picked up by a background refresh once the index is max_age old, so a
+        near-duplicate saved through another worker within that window isn't caught.
+        """
+        if not self.band_index.is_warm(user_id):
+            self._load_band_index(user_id)
+            return None
+        if self.band_index.is_stale(user_id):
+            self._load_band_index(user_id, since=self._refresh_since(user_id))
+        bands = fp.bands_from_fingerprint(fingerprint)
+        candidates = self.band_index.candidates(user_id, bands, N_DEDUP_CANDIDATES, MIN_BAND_MATCHES)
+        # same as similarity_dot_product between the two fingerprints
+        return {url_id: (1 + matches / len(bands)) / 2 for url_id, matches in candidates}
+
+
+    @staticmethod
+    def _candidate_rows(candidates: Dict[UUID, float], rs) -> list:
+        # candidates that aren't in the db yet (still being written) have no minhashes, like legacy rows
+        minhashes = {row.url_id: row.minhashes for row in rs}
+        return [SN(minhashes=minhashes.get(url_id), score=score) for url_id, score in candidates.items()]
+
+
+    def reserve_page(self, user_id, url_id, minhashes: np.ndarray) -> None:
+        """
+        Makes a page visible to deduplication right away, before (or while) it is written.  Callers
+        deduplicating pages concurrently reserve each page as soon as it is found not to be a duplicate.
+        """
+        self.band_index.add(user_id, url_id, fp.bands_from_minhashes(minhashes[np.newaxis])[0])
+
+
+    def release_page(self, user_id, url_id) -> None:
+        """Undoes reserve_page for a page that failed to save"""
+        self.band_index.discard(user_id, url_id)
+
+
+    def load_band_index(self, user_id, since: Optional[UUID] = None) -> None:
+        """Loads the user's pages (or those newer than `since`) into the band index"""
+        if since:
+            rs = chain(*(self.session.execute(self.statements['page_minhashes_since'], (*self._pk(user_id, month), since))
+                         for month in self._buckets(user_id) if month is None or month >= month_of(since)))
+        else:
+            rs = self._all_buckets('all_page_minhashes', user_id)
+        pages, legacy = [], []
+        for row in rs:
+            if row.minhashes:
+                pages.append((row.url_id, fp.unpack_minhashes(row.minhashes)))
+            else:
+                legacy.append(row.url_id)
+        bands = []
+        for start in range(0, len(pages), 1000):
+            batch = pages[start:start + 1000]
+            batch_bands = fp.bands_from_minhashes(np.stack([minhashes for _, minhashes in batch]))
+            bands.extend(zip([url_id for url_id, _ in batch], batch_bands))
+        # pages saved before we stored minhashes only have the fingerprint
+        for pk, url_ids in self._by_bucket(user_id, legacy):
+            for start in range(0, len(url_ids), 100):
+                rs = self.session.execute(self.statements['page_fingerprints'], (*pk, url_ids[start:start + 100]))
+                bands.extend((row.url_id, fp.bands_from_fingerprint(row.fingerprint)) for row in rs)
+        self.band_index.load(user_id, bands)
+
+
+    def _load_band_index(self, user_id, since: Optional[UUID] = None) -> None:
+        """load_band_index on a background thread, unless one is already running for this user"""
+        with self._band_loads_lock:
+            if user_id in self._band_loads:
+                return
+            self._band_loads.add(user_id)
+
+        def load():
+            try:
+                self.load_band_index(user_id, since)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._band_loads_lock:
+                    self._band_loads.discard(user_id)
+
+        threading.Thread(target=load, name=f'band-index-{user_id}', daemon=True).start()
+
+
+    @staticmethod
+    def _is_similar(rows, minhashes: np.ndarray) -> bool:
+        # The LSH fingerprint loses accuracy as documents get longer (more collisions inflate the
+        # similarity), so ANN (or the band index) only picks the candidates; the decision is made on
+        # the Jaccard estimate from the raw minhashes.  Pages saved before we stored minhashes fall
+        # back to the fingerprint similarity.
+        exact = [fp.unpack_minhashes(row.minhashes) for row in rows if row.minhashes]
+        if exact and fp.jaccard(np.stack(exact), minhashes).max() >= DUPLICATE_THRESHOLD:
+            return True
+        return any(row.score >= DUPLICATE_THRESHOLD for row in rows if not row.minhashes)
@@ -0,0 +1,133 @@
+import atexit
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+import xxhash
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings, keyed by model name + xxhash of the text, shared by every
+    process that opens the same path.
+
+    Vectors live in a memory-mapped float32 file with one row per slot, next to files recording
+    which key owns each slot and when it was last used.  The slots form a set-associative table:
+    a key can only live in the WAYS slots of the set its hash picks, so any process can find it
+    without an index.  When a set is full, its least recently used slot is reused.
+
+    Writers serialize on an flock; readers take no lock, and check that the slot still belongs to
+    their key after copying the vector out, since a writer clears the key before overwriting it.
+    """
+    WAYS = 8
+
+    def __init__(self, path: str, dimension: int = 768, capacity: int = 100_000) -> None:
+        self.path = path
+        self.dimension = dimension
+        self.n_sets = max(1, capacity // self.WAYS)
+        self.capacity = self.n_sets * self.WAYS
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._lock_file = open(os.path.join(path, 'lock'), 'w')
+        shape = f'{dimension}x{self.capacity}'
+        files = [(f'vectors_{shape}.f32', np.float32, (self.capacity, dimension)),
+                 (f'keys_{shape}.u64', np.uint64, (self.capacity,)),
+                 (f'used_{shape}.u32', np.uint32, (self.capacity,))]
+        with self._write_lock():
+            # sized under the lock, so workers starting together don't clobber each other's files
+            for name, dtype, file_shape in files:
+                file_path = os.path.join(path, name)
+                size = int(np.prod(file_shape)) * np.dtype(dtype).itemsize
+                if not os.path.exists(file_path) or os.path.getsize(file_path) != size:
+                    with open(file_path, 'wb') as f:
+                        f.truncate(size)
+        self._vectors, self._keys, self._used = [
+            np.memmap(os.path.join(path, name), dtype=dtype, mode='r+', shape=file_shape)
+            for name, dtype, file_shape in files]
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _write_lock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key(model: str, text: str) -> int:
+        # 0 marks an empty slot
+        return xxhash.xxh64_intdigest(f'{model}\0{text}'.encode('utf-8')) or 1
+
+    def _ways(self, key: int) -> slice:
+        start = (key % self.n_sets) * self.WAYS
+        return slice(start, start + self.WAYS)
+
+    def _find(self, key: int) -> Optional[int]:
+        ways = self._ways(key)
+        matches = np.flatnonzero(self._keys[ways] == key)
+        return ways.start + int(matches[0]) if len(matches) else None
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Cached vectors for each text, or None where the text has not been seen"""
+        results = []
+        now = int(time.time())
+        for text in texts:
+            key = self.key(model, text)
+            slot = self._find(key)
+            vector = None
+            if slot is not None:
+                vector = np.array(self._vectors[slot])
+                if self._keys[slot] == key:
+                    self._used[slot] = now
+                else:
+                    vector = None  # overwritten while we were reading it
+            results.append(vector)
+        with self._lock:
+            hits = sum(vector is not None for vector in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]) -> None:
+        now = int(time.time())
+        evictions = 0
+        with self._lock, self._write_lock():
+            for text, vector in zip(texts, vectors):
+                key = self.key(model, text)
+                slot = self._find(key)
+                if slot is None:
+                    ways = self._ways(key)
+                    empty = np.flatnonzero(self._keys[ways] == 0)
+                    if len(empty):
+                        slot = ways.start + int(empty[0])
+                    else:
+                        slot = ways.start + int(np.argmin(self._used[ways]))
+                        evictions += 1
+                # readers treat the slot as empty until the new vector is complete
+                self._keys[slot] = 0
+                self._vectors[slot] = vector
+                self._keys[slot] = key
+                self._used[slot] = now
+            self.evictions += evictions
+
+    def flush(self) -> None:
+        self._vectors.flush()
+        self._keys.flush()
+        self._used.flush()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': int(np.count_nonzero(self._keys))}
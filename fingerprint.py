@@ -1,3 +1,4 @@
+import itertools
 import xxhash
 import numpy as np
 from typing import Dict, Any, Set, List, Tuple
@@ -9,6 +10,15 @@ _MAX_HASH = np.uint64((1 << 32) - 1)
 _MERSENNE_PRIME = np.uint64((1 << 61) - 1)
 
 
+def _words(content: str):
+    """The same words as _NON_ALPHA.split(content), one at a time instead of in a list"""
+    start = 0
+    for match in _NON_ALPHA.finditer(content):
+        yield content[start:match.start()]
+        start = match.end()
+    yield content[start:]
+
+
 def mh_permutations(num_perm: int) -> np.ndarray:
     def generate_coprime(prime: int) -> int:
         while True:
@@ -24,6 +34,131 @@ def mh_permutations(num_perm: int) -> np.ndarray:
     return np.array([a, b])
 
 
+# xxh64 primes, for hashing the LSH bands in bulk
+_P1 = np.uint64(11400714785074694791)
+_P2 = np.uint64(14029467366897019727)
+_P3 = np.uint64(1609587929392839161)
+_P4 = np.uint64(9650029242287828579)
+_P5 = np.uint64(2870177450012600261)
+# default ceiling for the working memory of mh_minhashes, in bytes
+MEMORY_LIMIT = 8 * 1024 * 1024
+
+
+def _rotl(x: np.ndarray, r: int) -> np.ndarray:
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def _xxh64_round(acc: np.ndarray, lane: np.ndarray) -> np.ndarray:
+    return _rotl(acc + lane * _P2, 31) * _P1
+
+
+def _xxh64_lanes(lanes: np.ndarray) -> np.ndarray:
+    """
+    Vectorized xxh64 (seed 0) of each row of little-endian uint64 lanes.
+    Equivalent to `xxhash.xxh64(row.tobytes()).intdigest()` for every row.
+    """
+    n_rows, n_lanes = lanes.shape
+    with np.errstate(over='ignore'):
+        i = 0
+        if n_lanes >= 4:
+            v = [np.full(n_rows, seed, dtype=np.uint64) for seed in (_P1 + _P2, _P2, 0, np.uint64(0) - _P1)]
+            for i in range(0, n_lanes - 3, 4):
+                v = [_xxh64_round(v[k], lanes[:, i + k]) for k in range(4)]
+            i += 4
+            h = _rotl(v[0], 1) + _rotl(v[1], 7) + _rotl(v[2], 12) + _rotl(v[3], 18)
+            for acc in v:
+                h = (h ^ _xxh64_round(np.zeros(n_rows, dtype=np.uint64), acc)) * _P1 + _P4
+        else:
+            h = np.full(n_rows, _P5, dtype=np.uint64)
+        h += np.uint64(n_lanes * 8)
+        for i in range(i, n_lanes):
+            h ^= _xxh64_round(np.zeros(n_rows, dtype=np.uint64), lanes[:, i])
+            h = _rotl(h, 27) * _P1 + _P4
+        h ^= h >> np.uint64(33)
+        h *= _P2
+        h ^= h >> np.uint64(29)
+        h *= _P3
+        h ^= h >> np.uint64(32)
+    return h
+
+
+def mh_minhashes(
+        content: str,
+        *,
+        ngram_size: int,
+        n_minhashes: int,
+        permutations: np.ndarray,
+        memory_limit: int = MEMORY_LIMIT,
+) -> np.ndarray:
+    """
+    Compute the raw MinHash values for the given content.
+
+    Shingles are hashed and permuted a block at a time and folded into a running minimum, so
+    the working set stays under memory_limit bytes however long the document is.  (Duplicate
+    shingles don't change the minimum, so there is no need to collect them in a set first.)
+
+    Returns:
+        np.ndarray: n_minhashes uint64 values, each less than 2**32.
+    """
+    a, b = permutations
+    block_size = max(1, memory_limit // (2 * n_minhashes * np.dtype(np.uint64).itemsize))
+    permuted = np.empty((block_size, n_minhashes), dtype=np.uint64)
+    block_min = np.empty(n_minhashes, dtype=np.uint64)
+    minhashes = np.full(shape=n_minhashes, dtype=np.uint64, fill_value=_MAX_HASH)
+
+    tokens = (" ".join(t) for t in ngrams(_words(content), ngram_size))
+    while True:
+        hashvalues = np.fromiter((xxhash.xxh64_intdigest(token.encode("utf-8"))
+                                  for token in itertools.islice(tokens, block_size)), dtype=np.uint64)
+        if len(hashvalues) == 0:
+            break
+        block = permuted[:len(hashvalues)]
+        np.multiply(hashvalues[:, np.newaxis], a, out=block)
+        np.add(block, b, out=block)
+        np.remainder(block, _MERSENNE_PRIME, out=block)
+        np.bitwise_and(block, _MAX_HASH, out=block)
+        np.minimum(minhashes, block.min(axis=0, out=block_min), out=minhashes)
+    return minhashes
+
+
+def lsh_bands(minhashes: np.ndarray, *, signature_size: int, band_size: int) -> np.ndarray:
+    """
+    Hash each band of band_size minhashes and quantize it to one of signature_size // n_bands values.
+
+    Returns:
+        np.ndarray: (documents x n_bands) int64 band values.
+    """
+    n_docs, n_minhashes = minhashes.shape
+    n_bands = n_minhashes // band_size
+    bits_per_band = signature_size // n_bands
+    bands = _xxh64_lanes(np.ascontiguousarray(minhashes, dtype=np.uint64).reshape(n_docs * n_bands, band_size))
+    return (bands % np.uint64(bits_per_band)).astype(np.int64).reshape(n_docs, n_bands)
+
+
+def lsh_signatures(minhashes: np.ndarray, *, signature_size: int, band_size: int) -> np.ndarray:
+    """
+    Turn a (documents x n_minhashes) matrix of MinHash values into normalized LSH signatures.
+
+    Each band's quantized hash (see lsh_bands) sets one slot in that band's section of the signature.
+
+    Returns:
+        np.ndarray: (documents x signature_size) float32 signatures.
+    """
+    bands = lsh_bands(minhashes, signature_size=signature_size, band_size=band_size)
+    n_docs, n_bands = bands.shape
+    bits_per_band = signature_size // n_bands
+
+    # Create a float32 array of signature_size per document and set values to 1.0 based on the bands
+    signatures = np.zeros((n_docs, signature_size), dtype=np.float32)
+    indices = np.arange(n_bands, dtype=np.int64) * bits_per_band + bands
+    signatures[np.arange(n_docs)[:, np.newaxis], indices] = 1.0
+
+    # Normalize the signatures
+    norms = np.linalg.norm(signatures, axis=1, keepdims=True)
+    np.divide(signatures, norms, out=signatures, where=norms > 0)
+    return signatures
+
+
 def mh_signature(
         content: str,
         *,
@@ -47,41 +182,64 @@ def mh_signature(
     Returns:
         np.ndarray: The normalized MinHash signature.
     """
-    # Generate the raw minhash signature
-    a, b = permutations
-    masks = np.full(shape=n_minhashes, dtype=np.uint64, fill_value=_MAX_HASH)
-    tokens = set(" ".join(t) for t in ngrams(_NON_ALPHA.split(content), ngram_size))
-    hashvalues = np.fromiter((xxhash.xxh64(token.encode("utf-8")).intdigest() for token in tokens),
-                             dtype=np.uint64, count=len(tokens))
-    permuted_hashvalues = np.bitwise_and(
-        ((hashvalues[:, np.newaxis] * a + b) % _MERSENNE_PRIME), _MAX_HASH
-    )
-    hashvalues = np.vstack([permuted_hashvalues, masks]).min(axis=0)
-
-    # Generate the LSH bands and quantize down to the space available
-    n_bands = n_minhashes // band_size
-    bits_per_band = signature_size // n_bands
-    bands = [xxhash.xxh64(band.tobytes()).intdigest() % bits_per_band
-             for band in np.array_split(hashvalues, n_bands)]
-
-    # Create a float32 array of signature_size and set values to 1.0 based on the bands
-    signature = np.zeros(signature_size, dtype=np.float32)
-    indices = np.fromiter((i * bits_per_band + v for i, v in enumerate(bands)), dtype=np.int64)
-    signature[indices] = 1.0
-
-    # Normalize the signature
-    norm = np.linalg.norm(signature)
-    if norm > 0:
-        signature /= norm
-
-    return signature
+    minhashes = mh_minhashes(content, ngram_size=ngram_size, n_minhashes=n_minhashes, permutations=permutations)
+    return lsh_signatures(minhashes[np.newaxis], signature_size=signature_size, band_size=band_size)[0]
 
 _permutations = None
-def encode(text: str) -> np.array:
+def _load_permutations() -> np.ndarray:
     global _permutations
     if _permutations is None:
         _permutations = np.load('fingerprint_seed.npz')['arr']
-    return mh_signature(text, ngram_size=5, signature_size=2048, n_minhashes=256, band_size=4, permutations=_permutations)
+    return _permutations
+
+
+def encode(text: str) -> np.array:
+    return encode_many([text])[0]
+
+
+def encode_with_minhashes(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """The fingerprint of text, along with the raw minhashes it was built from"""
+    minhashes = _minhash_matrix([text], MEMORY_LIMIT)
+    return lsh_signatures(minhashes, signature_size=2048, band_size=4)[0], minhashes[0]
+
+
+def encode_many(texts: List[str], memory_limit: int = MEMORY_LIMIT) -> np.ndarray:
+    """Fingerprints for each of texts, as rows of a (len(texts) x 2048) matrix.  Row i is identical to encode(texts[i])."""
+    return lsh_signatures(_minhash_matrix(texts, memory_limit), signature_size=2048, band_size=4)
+
+
+def _minhash_matrix(texts: List[str], memory_limit: int) -> np.ndarray:
+    permutations = _load_permutations()
+    minhashes = np.empty((len(texts), 256), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        minhashes[i] = mh_minhashes(text, ngram_size=5, n_minhashes=256, permutations=permutations,
+                                    memory_limit=memory_limit)
+    return minhashes
+
+
+def bands_from_minhashes(minhashes: np.ndarray) -> np.ndarray:
+    """Band values of the fingerprints built from each row of minhashes, without building the fingerprints"""
+    return lsh_bands(minhashes, signature_size=2048, band_size=4)
+
+
+def bands_from_fingerprint(signature) -> np.ndarray:
+    """Recover the band values from a fingerprint, which has exactly one slot set per band"""
+    slots = np.flatnonzero(np.asarray(signature))
+    return slots % (len(signature) // len(slots))
+
+
+def pack_minhashes(minhashes: np.ndarray) -> bytes:
+    # minhashes are masked to 32 bits, so they fit in half the space
+    return minhashes.astype('<u4').tobytes()
+
+
+def unpack_minhashes(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype='<u4').astype(np.uint64)
+
+
+def jaccard(candidates: np.ndarray, minhashes: np.ndarray) -> np.ndarray:
+    """Estimated Jaccard similarity between minhashes and each row of candidates"""
+    return np.mean(candidates == minhashes, axis=1)
 
 
 def similarity(a, b):
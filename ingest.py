@@ -0,0 +1,134 @@
+import asyncio
+import fcntl
+import os
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Iterator, NamedTuple, Optional
+from uuid import UUID
+
+
+class PendingSave(NamedTuple):
+    user_id: str
+    timestamp_ns: int
+    url_id: UUID
+    path: str
+    fd: int
+
+
+class PendingJournal:
+    """
+    Durable list of the archived requests that an IngestQueue has accepted but not finished.
+
+    Each request is a file named <user_id>.<timestamp_ns> (its key in the archive) holding the
+    url_id it was promised.  The process working on the request holds an flock on the file until
+    it is done with it and removes it, so any file that can be locked was either deferred (accepted
+    while the queue was full) or left by a process that died, and its request is replayed.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, user_id: str, timestamp_ns: int, url_id: UUID) -> PendingSave:
+        path = os.path.join(self.path, f'{user_id}.{timestamp_ns}')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, str(url_id).encode('ascii'))
+        os.fsync(fd)
+        return PendingSave(user_id, timestamp_ns, url_id, path, fd)
+
+    def defer(self, pending: PendingSave) -> None:
+        """Leaves an accepted request for orphans() to claim, in this process or another one"""
+        os.close(pending.fd)
+
+    def done(self, pending: PendingSave) -> None:
+        # unlink before unlocking, so no other process can claim it in between
+        os.unlink(pending.path)
+        os.close(pending.fd)
+
+    def orphans(self) -> Iterator[PendingSave]:
+        """Claims the requests whose process died before finishing them"""
+        for fname in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, fname)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # another process may have finished and removed it between listing and locking
+                if not os.path.exists(path):
+                    raise FileNotFoundError(path)
+                user_id, timestamp_ns = fname.rsplit('.', 1)
+                url_id = UUID(os.read(fd, 64).decode('ascii'))
+            except (BlockingIOError, FileNotFoundError):
+                os.close(fd)
+                continue
+            except ValueError:
+                # torn write while the request was being accepted, before it was acknowledged
+                os.unlink(path)
+                os.close(fd)
+                continue
+            yield PendingSave(user_id, int(timestamp_ns), url_id, path, fd)
+
+
+class IngestQueue:
+    """
+    Bounded in-process work queue for the expensive half of save_if_new.
+
+    Requests are acknowledged as soon as they are submitted; a fixed pool of asyncio workers then
+    runs `process(*args)` for each one.  reserve() refuses new work instead of blocking when the
+    queue is full, so callers can leave the request somewhere durable to come back to.  There is no
+    per-request status: the acknowledgement is the whole contract, since the request is durable by
+    then, and failures are logged.
+    """
+    def __init__(self,
+                 process: Callable[..., Awaitable[Dict[str, str]]],
+                 n_workers: int = 4,
+                 max_pending: int = 256) -> None:
+        self.process = process
+        self.n_workers = n_workers
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+        self._n_pending = 0
+
+    def reserve(self) -> bool:
+        """Claims room for one request.  Returns False if the queue is full."""
+        if self._n_pending >= self.max_pending:
+            return False
+        self._n_pending += 1
+        return True
+
+    def release(self) -> None:
+        """Gives back a reservation that won't be submitted"""
+        self._n_pending -= 1
+
+    def submit(self, *args: Any, done: Optional[Callable[[], None]] = None) -> None:
+        """
+        Queue process(*args) to run in the background, in room claimed by reserve().  done(), if
+        given, is called once it has finished, however it turned out.
+        """
+        self._ensure_started()
+        self._queue.put_nowait((args, done))
+
+    def _ensure_started(self) -> None:
+        # workers are started lazily since they have to live on the server's event loop
+        if self._queue is None:
+            # reserve() bounds the queue
+            self._queue = asyncio.Queue()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.n_workers)]
+
+    async def _worker(self) -> None:
+        while True:
+            args, done = await self._queue.get()
+            try:
+                await self.process(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._n_pending -= 1
+                self._queue.task_done()
+                if done:
+                    try:
+                        done()
+                    except Exception:
+                        traceback.print_exc()
@@ -0,0 +1,227 @@
+import math
+import os
+import re
+from array import array
+from collections import Counter
+from itertools import groupby
+from types import SimpleNamespace as SN
+from typing import Dict, Iterable, List, Set, Tuple
+from uuid import UUID
+
+import numpy as np
+
+from chunk_store import ChunkStore, UserChunks, chunk_key
+from db import DB
+
+# Each user's index is a directory of:
+#   docs.bin        the chunk_store entries; a chunk's doc id is the number of its entry
+#   docs.jsonl      the chunk_store records
+#   postings.npz    a snapshot of the postings for the first n_docs chunks
+# docs.bin and docs.jsonl are the source of truth; chunks added after the snapshot are tokenized
+# again when the index is loaded.
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# write a new postings snapshot once this many chunks, or this fraction of the snapshot (whichever
+# is more), have been added since the last one.  Growing the interval with the index keeps the
+# total cost of rewriting it linear in its size.
+SNAPSHOT_EVERY = 1000
+SNAPSHOT_GROWTH = 0.25
+
+_TOKEN = re.compile(r"\w+(?:[.\-]\w+)*")
+_TOKEN_PARTS = re.compile(r"[._\-]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercased words.  Identifiers like ERR_CONNECTION_RESET, os.path.join or x86-64 are kept
+    whole, so they match exactly, and their parts are indexed too.
+    """
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        parts = _TOKEN_PARTS.split(token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+
+class _Postings:
+    """
+    Doc ids and term frequencies for each term.  The snapshot part is a few flat arrays, with
+    each term's doc ids delta-encoded; postings added since then are kept in growable arrays.
+    Doc ids are assigned in increasing order, so every posting list stays sorted.
+    """
+    def __init__(self) -> None:
+        self.n_docs = 0
+        self.terms: Dict[str, int] = {}
+        self.starts = np.zeros(1, dtype=np.int64)
+        self.deltas = np.empty(0, dtype=np.uint32)
+        self.tfs = np.empty(0, dtype=np.uint16)
+        self.lengths = array('I')
+        self.tail: Dict[str, Tuple[array, array]] = {}
+
+    @classmethod
+    def load(cls, path: str) -> '_Postings':
+        postings = cls()
+        with np.load(path) as data:
+            terms = data['terms'].tobytes().decode('utf-8')
+            postings.terms = {term: i for i, term in enumerate(terms.split('\n'))} if terms else {}
+            postings.starts = data['starts']
+            postings.deltas = data['deltas']
+            postings.tfs = data['tfs']
+            postings.lengths = array('I', data['lengths'].tobytes())
+            postings.n_docs = len(postings.lengths)
+        return postings
+
+    def save(self, path: str) -> None:
+        terms = sorted(set(self.terms) | set(self.tail))
+        starts, deltas, tfs = [0], [], []
+        for term in terms:
+            doc_ids, term_tfs = self.get(term)
+            deltas.append(np.diff(doc_ids, prepend=0).astype(np.uint32))
+            tfs.append(term_tfs)
+            starts.append(starts[-1] + len(doc_ids))
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 terms=np.frombuffer('\n'.join(terms).encode('utf-8'), dtype=np.uint8),
+                 starts=np.array(starts, dtype=np.int64),
+                 deltas=np.concatenate(deltas) if deltas else np.empty(0, dtype=np.uint32),
+                 tfs=np.concatenate(tfs) if tfs else np.empty(0, dtype=np.uint16),
+                 lengths=np.frombuffer(self.lengths, dtype=np.uint32))
+        os.replace(tmp_path, path)
+
+    def add(self, doc_id: int, tokens: List[str]) -> None:
+        assert doc_id == len(self.lengths)
+        self.lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            entry = self.tail.get(term)
+            if entry is None:
+                entry = self.tail[term] = (array('I'), array('H'))
+            entry[0].append(doc_id)
+            entry[1].append(min(tf, 65535))
+
+    def get(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        doc_ids, tfs = [], []
+        i = self.terms.get(term)
+        if i is not None:
+            start, end = self.starts[i], self.starts[i + 1]
+            doc_ids.append(np.cumsum(self.deltas[start:end], dtype=np.int64))
+            tfs.append(self.tfs[start:end])
+        entry = self.tail.get(term)
+        if entry is not None:
+            doc_ids.append(np.frombuffer(entry[0], dtype=np.uint32).astype(np.int64))
+            # copied, since an array can't grow while numpy holds a view of it
+            tfs.append(np.frombuffer(entry[1], dtype=np.uint16).copy())
+        if not doc_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint16)
+        return np.concatenate(doc_ids), np.concatenate(tfs)
+
+
+class _UserIndex(UserChunks):
+    entries_name = 'docs.bin'
+    records_name = 'docs.jsonl'
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self.postings = _Postings()
+        self.snapshot_mtime = 0
+
+    def refresh(self) -> None:
+        """Indexes chunks added since the last refresh, by this process or another one"""
+        snapshot_path = self.file('postings.npz')
+        snapshot_mtime = os.stat(snapshot_path).st_mtime_ns if os.path.exists(snapshot_path) else 0
+        if snapshot_mtime != self.snapshot_mtime:
+            # start over from the newer snapshot instead of holding on to a long tail
+            self.snapshot_mtime = snapshot_mtime
+            self.postings = _Postings.load(snapshot_path)
+        super().refresh()
+        unindexed = range(len(self.postings.lengths), self.n)
+        if not unindexed:
+            return
+        for doc_id, record in zip(unindexed, self.records(unindexed)):
+            self.postings.add(doc_id, tokenize(record['chunk']))
+
+
+class LexicalIndex(ChunkStore):
+    """
+    BM25 index of each user's chunks, kept on local disk, for finding exact words (names,
+    identifiers, error codes) that vector search ranks poorly.
+
+    Pages are added by add() as they are saved; sync() copies anything missed from the database.
+    Several processes can share the files: writes are serialized by a lock file, and each process
+    picks up the others' chunks when it next searches.
+    """
+    def _new_user(self, path: str) -> _UserIndex:
+        return _UserIndex(path)
+
+    def add(self, user_id: UUID, url_id: UUID, full_url: str, title: str, chunks: Iterable[str],
+            snapshot: bool = True) -> None:
+        """Indexes a page's chunks.  snapshot=False leaves the postings snapshot to the caller."""
+        user = self._user(user_id)
+        with user.writing():
+            self._append(user, url_id, full_url, title, chunks)
+            unsaved = user.n - user.postings.n_docs
+            if snapshot and unsaved >= max(SNAPSHOT_EVERY, SNAPSHOT_GROWTH * user.postings.n_docs):
+                self._snapshot(user)
+
+    @staticmethod
+    def _snapshot(user: _UserIndex) -> None:
+        # called with the user's locks held
+        user.postings.save(user.file('postings.npz'))
+        user.refresh()
+
+    def snapshot(self, user_id: UUID) -> None:
+        """Writes a postings snapshot of the user's chunks, if any were added since the last one"""
+        user = self._user(user_id)
+        with user.writing():
+            if user.n > user.postings.n_docs:
+                self._snapshot(user)
+
+    def search(self, user_id: UUID, query: str, limit: int = 50) -> List[SN]:
+        """Up to `limit` chunks, best first, with full_url, title, chunk, url_id and (BM25) score"""
+        user = self._user(user_id)
+        with user.lock:
+            user.refresh()
+            n, docs, postings = user.n, user.entries, user.postings
+            live = docs['live'] == 1
+            if not live.any():
+                return []
+            lengths = np.frombuffer(postings.lengths, dtype=np.uint32)[:n].astype(np.float32)
+            n_live = np.count_nonzero(live)
+            avg_length = lengths[live].mean() or 1.0
+            scores = np.zeros(n, dtype=np.float32)
+            for term in set(tokenize(query)):
+                doc_ids, tfs = postings.get(term)
+                doc_ids = doc_ids[doc_ids < n]
+                tfs = tfs[:len(doc_ids)]
+                keep = live[doc_ids]
+                doc_ids, tfs = doc_ids[keep], tfs[keep].astype(np.float32)
+                if not len(doc_ids):
+                    continue
+                idf = math.log(1 + (n_live - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+                norm = K1 * (1 - B + B * lengths[doc_ids] / avg_length)
+                scores[doc_ids] += idf * tfs * (K1 + 1) / (tfs + norm)
+            top = np.flatnonzero(scores)
+            top = top[np.argsort(-scores[top])[:limit]]
+            return [SN(url_id=UUID(bytes=docs['url_id'][doc_id].tobytes()), score=float(scores[doc_id]), **record)
+                    for doc_id, record in zip(top, user.records(top))]
+
+    def _stale_pages(self, db: DB, user_id: UUID, local: Set[int], current: Set[int]) -> Iterable[list]:
+        # a page's chunks come back together and in order, so a page with any chunk missing is added whole
+        for url_id, rows in groupby(db.chunk_texts(user_id), key=lambda row: row.url_id):
+            rows = list(rows)
+            keys = [chunk_key(url_id, row.ordinal) for row in rows]
+            current.update(keys)
+            if not local.issuperset(keys):
+                yield rows
+
+    def _add_page(self, user_id: UUID, rows: list) -> None:
+        # snapshotted once at the end, rather than over and over as a large first sync grows
+        self.add(user_id, rows[0].url_id, rows[0].full_url, rows[0].title, [row.chunk for row in rows],
+                 snapshot=False)
+
+    def _synced(self, user_id: UUID, n_added: int) -> None:
+        if n_added:
+            self.snapshot(user_id)
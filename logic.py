@@ -1,9 +1,8 @@
-import gzip
-import json
+import asyncio
 import os
-import time
+import traceback
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict
+from typing import AsyncGenerator, Optional, List, Dict
 from uuid import uuid4, uuid1, UUID
 from types import SimpleNamespace as SN
 
@@ -12,48 +11,66 @@ import numpy as np
 import re
 from sklearn.feature_extraction.text import CountVectorizer
 
-from config import tr_data_dir
-from db import DB
+from config import tr_data_dir, mirror, lexical
+from db import DB, N_RESULTS, N_RESULTS_PER_PAGE, SEARCH_DEPTH, MAX_SEARCH_DEPTH, aggregate_by_url
 from util import humanize_datetime
+from ingest import IngestQueue, PendingJournal
+from result_cache import SearchResultCache
+from single_flight import SingleFlight
+from preformat import PreformatScheduler
+from query_cache import normalize_query
+import archive
+import codec
 import fingerprint
-from ai import summarize, encode, tokenize, token_length, ai_format
+from ai import summarize, encode_async, encode_query, tokenize, tokenize_batch, token_length, ai_format_async, FORMAT_CONCURRENCY, data_dir
 
 
 # weird-ass nltk doesn't do this automatically
 nltk.download('punkt')
 nltk.download('punkt_tab')
 
+search_cache = SearchResultCache(os.path.join(data_dir, 'search_generations'))
+# requests acknowledged by save_in_background that haven't been ingested yet
+pending_saves = PendingJournal(os.path.join(tr_data_dir, 'pending'))
+# how often each process looks for journaled requests that nobody is working on
+PENDING_RESUME_INTERVAL = 10.0
+
+
+def _split_to_fit(sentence: str, tokens: List[int], max_tokens: int):
+    """Yields (part, token count) pieces of sentence that are at most max_tokens long"""
+    if len(tokens) <= max_tokens:
+        yield sentence, len(tokens)
+        return
+    # split between words, so no word (or multi-byte character) is cut in half.  The tokenizer
+    # attaches the space before a word to the word, so the words' counts add up to the part's
+    words = sentence.split()
+    part = []
+    part_count = 0
+    for word, word_tokens in zip(words, tokenize_batch([' ' + word for word in words])):
+        # skip huge words, like base64 blobs or urls
+        # (we could split them by token but it's unlikely to be useful information)
+        if len(word_tokens) > max_tokens:
+            continue
+        if part_count + len(word_tokens) > max_tokens:
+            yield ' '.join(part), part_count
+            part = []
+            part_count = 0
+        part.append(word)
+        part_count += len(word_tokens)
+    if part:
+        yield ' '.join(part), part_count
+
 
 def _group_sentences_with_overlap(sentences, max_tokens):
     grouped_sentences = []
     current_group = []
     current_token_count = 0
     last_sentence = ""
+    last_sentence_count = 0
 
-    # Group sentences in chunks of max_tokens
-    for sentence in sentences:
-        parts_to_process = [sentence]
-
-        while parts_to_process:
-            part = parts_to_process.pop(0)
-            token_count = token_length(part)
-
-            # If the part is too long even solo, split it
-            while token_count > max_tokens:
-                words = part.split()
-                if len(words) >= 2:
-                    mid = len(words) // 2
-                    parts_to_process.insert(0, ' '.join(words[mid:]))
-                    part = ' '.join(words[:mid])
-                    token_count = token_length(part)
-                else:
-                    # one huge "word"
-                    break
-            # skip the one-huge-word case
-            # (we could split it by token but it's unlikely to be useful information, so we'll just skip it)
-            if token_count > max_tokens:
-                continue
-
+    # Group sentences in chunks of max_tokens, tokenizing each sentence exactly once
+    for sentence, tokens in zip(sentences, tokenize_batch(sentences)):
+        for part, token_count in _split_to_fit(sentence, tokens, max_tokens):
             # Start a new group if the current part doesn't fit
             if current_token_count + token_count > max_tokens:
                 grouped_sentences.append(current_group)
@@ -63,15 +80,16 @@ def _group_sentences_with_overlap(sentences, max_tokens):
                 current_token_count = token_count
 
                 # Add the last_sentence to the new group if there's room after adding the first sentence
-                if last_sentence and current_token_count + token_length(last_sentence) <= max_tokens:
+                if last_sentence and current_token_count + last_sentence_count <= max_tokens:
                     current_group.insert(0, last_sentence)
-                    current_token_count += token_length(last_sentence)
+                    current_token_count += last_sentence_count
             else:
                 # Add the current part to the existing group
                 current_group.append(part)
                 current_token_count += token_count
 
             last_sentence = part
+            last_sentence_count = token_count
 
     # Add the last group if it's not empty
     if current_group:
@@ -85,7 +103,7 @@ def _clean_text(text: str) -> str:
     normalized = re.sub(r'\s+', ' ', text)
     # remove non-utf-8 characters, gemini doesn't like them
     return normalized.encode('utf-8', 'ignore').decode('utf-8')
-def _save_article(db: DB, text: str, fingerprint: np.array, url: str, title: str, user_id: uuid4, url_id: uuid1) -> None:
+def _chunk_article(text: str, title: str) -> tuple[str, str, List[str]]:
     text = _clean_text(text)
     title = _clean_text(title)
     sentences = [sentence.strip() for sentence in nltk.sent_tokenize(text)]
@@ -94,8 +112,56 @@ def _save_article(db: DB, text: str, fingerprint: np.array, url: str, title: str
     if title not in text:
         group_texts.insert(0, title)
     # print(group_texts)
-    vectors = encode(group_texts)
-    db.upsert_chunks(user_id, url, title, text, fingerprint.tolist(), zip(group_texts, vectors), url_id)
+    return text, title, group_texts
+
+
+async def _save_article_async(db: DB, text: str, fingerprint: np.array, minhashes: np.array, url: str, title: str, user_id: uuid4, url_id: uuid1) -> None:
+    text, title, group_texts = await asyncio.to_thread(_chunk_article, text, title)
+    await _store_article_async(db, url, user_id, url_id, text, title, fingerprint, minhashes, group_texts)
+
+
+async def _store_article_async(db: DB, url: str, user_id: uuid4, url_id: uuid1, text: str, title: str,
+                               fingerprint: np.array, minhashes: np.array, group_texts: List[str]) -> None:
+    vectors = await encode_async(group_texts)
+    await db.upsert_chunks_async(user_id, url, title, text, fingerprint.tolist(), minhashes, zip(group_texts, vectors), url_id)
+    await asyncio.to_thread(_index_locally, user_id, url_id, url, title, group_texts, vectors)
+    search_cache.bump(user_id)
+
+
+def _index_locally(user_id: UUID, url_id: uuid1, url: str, title: str, group_texts: List[str], vectors: List[List[float]]) -> None:
+    """Writes saved chunks through to the local search mirror and lexical index, if enabled"""
+    if mirror is not None:
+        try:
+            mirror.add(user_id, url_id, url, title, zip(group_texts, vectors))
+        except Exception:
+            # the page is saved; the mirror just can't be trusted for this user until it is re-synced
+            print(f"Failed to mirror chunks of {url}")
+            traceback.print_exc()
+            mirror.mark_unsynced(user_id)
+    if lexical is not None:
+        try:
+            lexical.add(user_id, url_id, url, title, group_texts)
+        except Exception:
+            print(f"Failed to index chunks of {url}")
+            traceback.print_exc()
+
+
+def prepare_article(text: str, title: str) -> SN:
+    """
+    The CPU-bound part of saving an article (fingerprinting and chunking), with no i/o, so that
+    bulk loads can run it in a process pool.  Pass the result to store_prepared_async.
+    """
+    fp, minhashes = fingerprint.encode_with_minhashes(text)
+    if token_length(title) < 1:
+        title = "[Untitled]"
+    text, title, group_texts = _chunk_article(text, title)
+    return SN(fingerprint=fp, minhashes=minhashes, text=text, title=title, group_texts=group_texts)
+
+
+async def store_prepared_async(db: DB, article: SN, url: str, user_id: UUID, url_id: uuid1) -> None:
+    """Embeds and saves an article from prepare_article.  Deduplication is up to the caller."""
+    await _store_article_async(db, url, user_id, url_id, article.text, article.title,
+                               article.fingerprint, article.minhashes, article.group_texts)
 
 
 def _is_different(text, last_version):
@@ -131,44 +197,109 @@ sites_to_ignore = {
     'calendar.google.com',      # nothing useful
     'docs.google.com/document', # nothing useful
 }
-def save_if_new(db: DB,
-                url: str,
-                title: str,
-                text: str,
-                user_id: UUID,
-                url_id: Optional[uuid1] = None) -> dict[str, str]:
-    save_locally(text, title, url, user_id)
-
-    for site in sites_to_ignore:
-        if site in url:
-            return {'result': 'ignored'}
-
+def is_ignored(url: str) -> bool:
+    return any(site in url for site in sites_to_ignore)
+
+
+async def save_in_background(queue: IngestQueue,
+                             url: str,
+                             title: str,
+                             text: str,
+                             user_id: UUID) -> dict[str, str]:
+    """
+    Durably records the request and hands the rest of save_if_new to the ingest queue.
+    Returns 'queued' with the url_id the page will be saved under.  Queued requests are journaled
+    until they are done; if the queue is full, the request is left in the journal for
+    resume_pending_saves to queue once there's room.
+    """
+    timestamp_ns = await asyncio.to_thread(save_locally, text, title, url, user_id)
+    if is_ignored(url):
+        return {'result': 'ignored'}
+
+    url_id = uuid1()
+    pending = await asyncio.to_thread(pending_saves.add, str(user_id), timestamp_ns, url_id)
+    if queue.reserve():
+        queue.submit(url, title, text, user_id, url_id, done=lambda: pending_saves.done(pending))
+    else:
+        pending_saves.defer(pending)
+    return {'result': 'queued', 'url_id': str(url_id)}
+
+
+async def resume_pending_saves(queue: IngestQueue) -> int:
+    """
+    Queues journaled requests that no process is working on, while the queue has room: those
+    deferred because a queue was full, and those left unfinished by a process that died.
+    Returns how many.
+    """
+    n_resumed = 0
+    orphans = pending_saves.orphans()
+    # reserved before claiming, so requests that don't fit stay in the journal for the next pass
+    while queue.reserve():
+        pending = await asyncio.to_thread(next, orphans, None)
+        if pending is None:
+            queue.release()
+            break
+        request = await asyncio.to_thread(_load_archived, pending.user_id, pending.timestamp_ns)
+        if request is None:
+            print(f"Pending save {pending.user_id}/{pending.timestamp_ns} is not in the archive")
+            pending_saves.done(pending)
+            queue.release()
+            continue
+        queue.submit(request['url'], request['title'], request['text_content'], UUID(request['user_id']),
+                     pending.url_id, done=lambda pending=pending: pending_saves.done(pending))
+        n_resumed += 1
+    orphans.close()
+    return n_resumed
+
+
+async def resume_pending_saves_forever(queue: IngestQueue, interval: float = PENDING_RESUME_INTERVAL) -> None:
+    """Runs resume_pending_saves every `interval` seconds"""
+    while True:
+        try:
+            n_resumed = await resume_pending_saves(queue)
+            if n_resumed:
+                print(f"Resumed {n_resumed} pending saves")
+        except Exception:
+            traceback.print_exc()
+        await asyncio.sleep(interval)
+
+
+def _load_archived(user_id: str, timestamp_ns: int) -> Optional[dict]:
+    for request in archive.iter_requests(tr_data_dir, {user_id}, timestamp_ns, timestamp_ns + 1):
+        return request.load()
+    return None
+
+
+async def ingest_async(db: DB,
+                       url: str,
+                       title: str,
+                       text: str,
+                       user_id: UUID,
+                       url_id: uuid1,
+                       preformatter: Optional[PreformatScheduler] = None) -> dict[str, str]:
+    """
+    The part of save_if_new that runs after the request is saved locally, without blocking the event loop.
+    Saved pages are handed to `preformatter`, if given, to be formatted before they are viewed.
+    """
     # check if the article is sufficiently different from the last version of the same url
-    fp = fingerprint.encode(text)
-    if db.similar_page_exists(user_id, fp):
+    fp, minhashes = await asyncio.to_thread(fingerprint.encode_with_minhashes, text)
+    if await db.similar_page_exists_async(user_id, fp, minhashes):
         return {'result': 'duplicate'}
 
     if token_length(title) < 1:
         title = "[Untitled]"
 
-    if not url_id:
-        url_id = uuid1()
-
     # save the article in the database
-    _save_article(db, text, fp, url, title, user_id, url_id)
+    await _save_article_async(db, text, fp, minhashes, url, title, user_id, url_id)
+    if preformatter:
+        # input plus output, which ai_format_async assumes is up to twice as long with the html tags
+        n_tokens = 3 * await asyncio.to_thread(token_length, text)
+        preformatter.submit(user_id, url_id, n_tokens)
     return {'result': 'saved', 'url_id': str(url_id)}
 
 
 def save_locally(text, title, url, user_id):
     user_id_str = str(user_id)
-    # create a filename based on the current time.  if it already exists, increment it.
-    t = time.time_ns()
-    while True:
-        full_path = f'{tr_data_dir}/{user_id_str}/{t}.gz'
-        if not os.path.exists(full_path):
-            break
-        t += 1
-    os.makedirs(os.path.dirname(full_path), exist_ok=True)
     # json-ify the raw request
     request_json = {
         "url": url,
@@ -176,9 +307,8 @@ def save_locally(text, title, url, user_id):
         "text_content": text,
         "user_id": user_id_str
     }
-    # write the request json to the file
-    with gzip.open(full_path, 'wt') as f:
-        json.dump(request_json, f)
+    # append it to the user's archive; this is on disk before we acknowledge the request
+    return archive.append(tr_data_dir, user_id_str, request_json)
 
 
 def recent_urls(db: DB, user_id: UUID, saved_before_str: Optional[str] = None) -> tuple[list[dict[str, Optional[str]]], datetime]:
@@ -193,23 +323,135 @@ def recent_urls(db: DB, user_id: UUID, saved_before_str: Optional[str] = None) -
     return [SN(**r) for r in results], oldest_saved_at
 
 
-def search(db: DB, user_id_str: str, search_text: str) -> list:
-    vector = encode(['query: ' + search_text])[0]
-    results = db.search(UUID(user_id_str), vector)
+def _search_chunks(db: DB, user_id: UUID, vector: List[float], depth: int) -> tuple[list, bool]:
+    """Returns (chunks closest to vector, whether they are complete enough to cache)"""
+    if mirror and mirror.is_synced(user_id):
+        return mirror.search_chunks(user_id, vector, depth), True
+    try:
+        return db.search_chunks(user_id, vector, depth), True
+    except Exception:
+        if mirror is None and lexical is None:
+            raise
+        # incomplete results are better than none
+        print("Search failed, falling back to local indexes")
+        traceback.print_exc()
+        return (mirror.search_chunks(user_id, vector, depth) if mirror else []), False
+
+
+# the usual constant for reciprocal rank fusion; it keeps the top few ranks of either list from dominating
+RRF_K = 60
+
+def _reciprocal_rank_fusion(*rankings) -> List[SN]:
+    """Merges rankings of chunks (best first) by summing 1 / (RRF_K + rank) for each chunk"""
+    fused: Dict[tuple, SN] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, 1):
+            entry = fused.get((row.url_id, row.chunk))
+            if entry is None:
+                entry = fused[(row.url_id, row.chunk)] = SN(full_url=row.full_url, title=row.title, chunk=row.chunk,
+                                              url_id=row.url_id, score=0.0)
+            entry.score += 1 / (RRF_K + rank)
+    return sorted(fused.values(), key=lambda row: row.score, reverse=True)
+
+
+_CURSOR = re.compile(r'(\d{1,9}):(\d{1,9})')
+
+def _parse_cursor(cursor: Optional[str]) -> tuple[int, int]:
+    """
+    A cursor is "<offset>:<depth>", the first URL of the page and how many chunks to rank.  It
+    comes from the client, so anything malformed starts over from the first page.
+    """
+    match = _CURSOR.fullmatch(cursor or '')
+    if not match:
+        return 0, SEARCH_DEPTH
+    offset, depth = int(match.group(1)), int(match.group(2))
+    return offset, max(SEARCH_DEPTH, min(depth, MAX_SEARCH_DEPTH))
+
+
+def _counted(rows, counter: List[int]):
+    for row in rows:
+        counter[0] += 1
+        yield row
+
+
+def search(db: DB,
+           user_id_str: str,
+           search_text: str,
+           cursor: Optional[str] = None,
+           page_size: int = N_RESULTS,
+           chunks_per_url: int = N_RESULTS_PER_PAGE) -> tuple[list, Optional[str]]:
+    """
+    Returns a page of results, and the cursor for the next page (or None if there are no more).
+    The first page ranks as many candidate chunks as it takes to fill it, and every later page of
+    the same query ranks exactly as many, so that the URLs keep their order from page to page.
+    """
+    user_id = UUID(user_id_str)
+    offset, depth = _parse_cursor(cursor)
+    vector = encode_query(search_text)
+    key = search_cache.key(user_id, vector, offset, page_size, chunks_per_url, depth)
+    cached = search_cache.get(key)
+    if cached is None:
+        # read the generation first, so a save that lands during the search invalidates the results
+        generation = search_cache.generation(user_id)
+        while True:
+            chunks, complete = _search_chunks(db, user_id, vector, depth)
+            n_candidates = [0]
+            chunks = _counted(chunks, n_candidates)
+            if lexical:
+                # exact words (names, identifiers, error codes) that the embeddings miss
+                chunks = _reciprocal_rank_fusion(chunks, lexical.search(user_id, normalize_query(search_text), depth))
+            # one extra URL tells us whether there is another page at this depth
+            results = aggregate_by_url(chunks, page_size + 1, chunks_per_url, offset)
+            # a deeper ranking would reorder the URLs already shown on earlier pages
+            if offset or len(results) > page_size or n_candidates[0] < depth or depth >= MAX_SEARCH_DEPTH:
+                break
+            # ran out of URLs before the end of the page, but not out of candidates
+            depth = min(depth * 2, MAX_SEARCH_DEPTH)
+        next_cursor = f"{offset + page_size}:{depth}" if len(results) > page_size else None
+        cached = {'results': results[:page_size], 'next_cursor': next_cursor}
+        if complete:
+            search_cache.put(key, generation, cached)
+    results = cached['results']
     for result in results:
         dt = _uuid1_to_datetime(result['url_id'])
         result['saved_at_human'] = humanize_datetime(dt)
         print(result)
-    return [SN(**r) for r in results]
+    return [SN(**r) for r in results], cached['next_cursor']
+
 
+# concurrent views of the same unformatted snapshot share one formatting run
+formatting_flights = SingleFlight()
 
-def stream_formatted_snapshot(db: DB, user_id: UUID, url_id: UUID) -> tuple[str, str]:
-    _, title, text_content, _ = db.load_snapshot(user_id, url_id)
 
+async def _format_and_save(db: DB, user_id: UUID, url_id: UUID, max_concurrency: int) -> AsyncGenerator[str, None]:
+    snapshot = await asyncio.to_thread(db.load_snapshot, user_id, url_id)
+    if snapshot is None:
+        # deleted, or never saved; there's nothing to format
+        return
+    _, title, text_content, content_gz = snapshot
+    if content_gz:
+        # formatted (or uploaded) since the page that asked for it was rendered
+        yield (await asyncio.to_thread(codec.decompress, content_gz)).decode('utf-8', 'ignore')
+        return
     formatted_pieces = []
-    for piece in ai_format(text_content):
+    async for piece in ai_format_async(text_content, max_concurrency):
         formatted_pieces.append(piece)
         yield piece
     formatted_content = ''.join(formatted_pieces)
-    content_gz = gzip.compress(formatted_content.encode('utf-8', 'ignore'))
-    db.save_formatting(user_id, url_id, content_gz)
+    content_gz = await asyncio.to_thread(codec.compress, formatted_content.encode('utf-8', 'ignore'), 'html')
+    await asyncio.to_thread(db.save_formatting, user_id, url_id, content_gz)
+
+
+async def stream_formatted_snapshot_async(db: DB,
+                                          user_id: UUID,
+                                          url_id: UUID,
+                                          max_concurrency: int = FORMAT_CONCURRENCY) -> AsyncGenerator[str, None]:
+    """
+    The snapshot formatted as html, streamed as it is generated (or all at once if it was formatted
+    before), or nothing if there is no such snapshot.  Formatting runs as a flight that later views
+    of the same snapshot attach to, and that carries on in the background (and is saved) if the
+    client goes away, so the work isn't wasted.  max_concurrency only applies if this starts the
+    flight; views that attach to a running one share its concurrency.
+    """
+    async for piece in formatting_flights.stream((user_id, url_id), lambda: _format_and_save(db, user_id, url_id, max_concurrency)):
+        yield piece
@@ -1,15 +1,37 @@
+import asyncio
 import gzip
+import zlib
+from functools import partial
 from uuid import UUID
 
 from fasthtml.common import *
-from starlette.responses import StreamingResponse
+from starlette.responses import JSONResponse, StreamingResponse
 
+import codec
 import logic
-from config import db
+from config import db, preformat_tokens_per_hour
+from ingest import IngestQueue
+from preformat import PreformatScheduler, PREFORMAT_CONCURRENCY
 from util import humanize_url, humanize_datetime
 
 
-app = FastHTML(hdrs=[picolink])
+# pre-formats newly saved pages in the background, if there's a budget for it
+preformatter = PreformatScheduler(logic.formatting_flights,
+                                  partial(logic.stream_formatted_snapshot_async, db, max_concurrency=PREFORMAT_CONCURRENCY),
+                                  preformat_tokens_per_hour) if preformat_tokens_per_hour else None
+ingest_queue = IngestQueue(partial(logic.ingest_async, db, preformatter=preformatter))
+
+
+# referenced, so they aren't garbage collected while they run
+_background_tasks = []
+
+
+async def resume_pending_saves():
+    # saves left unfinished by the last shutdown, and those deferred while the queue was full
+    _background_tasks.append(asyncio.create_task(logic.resume_pending_saves_forever(ingest_queue)))
+
+
+app = FastHTML(hdrs=[picolink], on_startup=[resume_pending_saves])
 
 
 @app.get("/")
@@ -78,9 +100,9 @@ def search(session, user_id: UUID | None = None, saved_before: str | None = None
 
 
 @app.post("/results")
-def results(session, search_text: str):
+def results(session, search_text: str, cursor: str | None = None):
     user_id = session['user_id']
-    search_results = logic.search(db, user_id, search_text)
+    search_results, next_cursor = logic.search(db, user_id, search_text, cursor)
 
     search_form = Search(
         Input(type="text", name="search_text", placeholder="Enter search text", value=search_text),
@@ -100,9 +122,17 @@ def results(session, search_text: str):
                        ))
         result_cards.append(card)
 
+    more_results_btn = Form(
+        Input(type="hidden", name="search_text", value=search_text),
+        Input(type="hidden", name="cursor", value=next_cursor),
+        Button("More results", type="submit", cls="outline"),
+        action="/results", method="post"
+    ) if next_cursor else None
+
     return Titled("Search Results",
                   Main(search_form,
                        *result_cards,
+                       more_results_btn,
                        A("Back to Search", href=f"/search", role="button"),
                        cls="container"))
 
@@ -123,11 +153,13 @@ async def save_if_new(request: Request):
     if not all([url, title, text_content, user_id]):
         raise HTTPException(status_code=400, detail="Missing required fields")
 
-    # Call the logic function with the extracted data
+    # Call the logic function with the extracted data; the page is fingerprinted, embedded and
+    # saved to the db after we respond
+    result = await logic.save_in_background(ingest_queue, url, title, text_content, user_id)
     # FIXME remove backwards-compatibility logic here
-    result = logic.save_if_new(db, url, title, text_content, user_id)
-    result['saved'] = result['result'] == 'saved'
-    return result
+    # older extensions only know 'saved'; a queued request is as good as saved, since it is already on disk
+    result['saved'] = result['result'] in ('saved', 'queued')
+    return JSONResponse(result, status_code=202 if result['result'] == 'queued' else 200)
 
 
 @app.post("/save_html")
@@ -146,8 +178,16 @@ async def save_html(request: Request):
     if not all([user_id, url_id, content_gz]):
         raise HTTPException(status_code=400, detail="Missing required fields")
 
+    # decompressing, recompressing, and the write all block, so keep them off the event loop
+    try:
+        html = await asyncio.to_thread(gzip.decompress, content_gz)
+    except (OSError, EOFError, zlib.error):
+        raise HTTPException(status_code=400, detail="Body is not valid gzip")
+
     # Call the logic function with the extracted data
-    return db.save_formatting(user_id, url_id, content_gz)
+    # store it in the same format as snapshots formatted on the server
+    content = await asyncio.to_thread(codec.compress, html, 'html')
+    return await asyncio.to_thread(db.save_formatting, user_id, url_id, content)
 
 
 @app.get("/snapshot/{url_id}")
@@ -169,7 +209,7 @@ def snapshot(session, url_id: UUID):
 def snapshot_iframe(session, url_id: UUID):
     user_id = UUID(session['user_id'])
     url, title, text_content, content_gz = db.load_snapshot(user_id, url_id)
-    formatted_content = gzip.decompress(content_gz).decode('utf-8') if content_gz else None
+    formatted_content = codec.decompress(content_gz).decode('utf-8') if content_gz else None
 
     if formatted_content:
         # Wrap the content in a full HTML structure
@@ -209,11 +249,7 @@ def snapshot_iframe(session, url_id: UUID):
 @app.get('/snapshot/stream/{url_id}/')
 async def snapshot_stream(session, url_id: UUID):
     user_id = UUID(session['user_id'])
-    async def generate():
-        for chunk in logic.stream_formatted_snapshot(db, user_id, url_id):
-            yield chunk
-
-    return StreamingResponse(generate(), media_type='text/html')
+    return StreamingResponse(logic.stream_formatted_snapshot_async(db, user_id, url_id), media_type='text/html')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+import os
+import time
+from types import SimpleNamespace as SN
+from typing import Dict, Iterable, List, Set, Tuple
+from uuid import UUID
+
+import numpy as np
+
+from chunk_store import ChunkStore, UserChunks, chunk_key
+from db import DB, SEARCH_DEPTH
+
+# Each user's mirror is a directory of:
+#   rows.bin     the chunk_store entries
+#   meta.jsonl   the chunk_store records
+#   vectors.f32  one float32 embedding per entry, written before the entry
+#   synced       present once sync() has copied everything in the database
+
+
+class _UserMirror(UserChunks):
+    entries_name = 'rows.bin'
+    records_name = 'meta.jsonl'
+
+    def __init__(self, path: str, dimension: int) -> None:
+        super().__init__(path)
+        self.dimension = dimension
+        self.vectors = np.empty((0, dimension), dtype=np.float32)
+
+    def refresh(self) -> None:
+        n = self.n
+        super().refresh()
+        if self.n != n:
+            self.vectors = np.memmap(self.file('vectors.f32'), dtype=np.float32, mode='r', shape=(self.n, self.dimension))
+
+
+class VectorMirror(ChunkStore):
+    """
+    Local copy of each user's chunk embeddings, for searching without a round trip to the
+    database (or while it is unavailable).
+
+    Vectors are memory-mapped from disk and searched by brute force: one matrix-vector product
+    over all of a user's chunks, which is cheap next to a remote ANN query even for users with
+    hundreds of thousands of chunks.
+
+    Pages are written through by add() as they are saved; sync() copies anything missed (pages
+    saved before the mirror was enabled, or by a process without it).  Until a user has been
+    synced, the mirror is only complete enough to be a fallback.
+    """
+    def __init__(self, path: str, dimension: int = 768) -> None:
+        super().__init__(path)
+        self.dimension = dimension
+
+    def _new_user(self, path: str) -> _UserMirror:
+        return _UserMirror(path, self.dimension)
+
+    def is_synced(self, user_id: UUID) -> bool:
+        return os.path.exists(os.path.join(self.path, str(user_id), 'synced'))
+
+    def add(self, user_id: UUID, url_id: UUID, full_url: str, title: str,
+            chunks: Iterable[Tuple[str, List[float]]]) -> None:
+        """Adds or replaces (chunk, embedding) rows, like DB.upsert_chunks_async"""
+        chunks = list(chunks)
+        user = self._user(user_id)
+        with user.writing():
+            with open(user.file('vectors.f32'), 'ab') as vectors:
+                # drop anything a crashed writer left past the last complete entry
+                vectors.truncate(user.n * self.dimension * 4)
+                vectors.write(np.asarray([embedding for _, embedding in chunks], dtype=np.float32).tobytes())
+            self._append(user, url_id, full_url, title, [chunk for chunk, _ in chunks])
+
+    def mark_unsynced(self, user_id: UUID) -> None:
+        """Called when a write-through failed, so the mirror is no longer complete"""
+        try:
+            os.unlink(os.path.join(self.path, str(user_id), 'synced'))
+        except FileNotFoundError:
+            pass
+
+    def search_chunks(self, user_id: UUID, vector: List[float], depth: int = SEARCH_DEPTH) -> List[SN]:
+        """The `depth` chunks closest to vector, best first, before aggregating them by URL"""
+        user = self._user(user_id)
+        with user.lock:
+            user.refresh()
+            n, entries, vectors = user.n, user.entries, user.vectors
+        if not n:
+            return []
+        # same score as the database's similarity_dot_product
+        scores = (1 + vectors @ np.asarray(vector, dtype=np.float32)) / 2
+        scores[entries['live'] == 0] = -np.inf
+        k = min(depth, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[np.isfinite(scores[top])]
+        return [SN(url_id=UUID(bytes=entries['url_id'][entry].tobytes()), score=float(scores[entry]), **record)
+                for entry, record in zip(top, user.records(top))]
+
+    def _stale_pages(self, db: DB, user_id: UUID, local: Set[int], current: Set[int]) -> Iterable[list]:
+        stale_pages: Dict[UUID, None] = {}
+        for url_id, ordinal in db.chunk_ids(user_id):
+            key = chunk_key(url_id, ordinal)
+            current.add(key)
+            if key not in local:
+                stale_pages[url_id] = None
+        stale = list(stale_pages)
+        # a few pages at a time, so a first sync doesn't hold all of the user's vectors in memory
+        for start in range(0, len(stale), 100):
+            pages: Dict[UUID, list] = {}
+            for row in db.load_chunks(user_id, stale[start:start + 100]):
+                pages.setdefault(row.url_id, []).append(row)
+            for rows in pages.values():
+                rows.sort(key=lambda row: row.ordinal)
+                yield rows
+
+    def _add_page(self, user_id: UUID, rows: list) -> None:
+        self.add(user_id, rows[0].url_id, rows[0].full_url, rows[0].title,
+                 [(row.chunk, row.embedding_g4) for row in rows])
+
+    def _synced(self, user_id: UUID, n_added: int) -> None:
+        with open(os.path.join(self.path, str(user_id), 'synced'), 'w') as f:
+            f.write(str(time.time()))
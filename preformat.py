@@ -0,0 +1,96 @@
+import asyncio
+import heapq
+import time
+import traceback
+from collections import deque
+from itertools import count
+from typing import AsyncIterator, Callable, Optional
+from uuid import UUID
+
+from single_flight import SingleFlight
+
+# how often a waiting scheduler checks whether interactive formatting has finished
+YIELD_INTERVAL = 1.0
+# sections of a page formatted at once in the background, leaving the rest of the model's rate
+# limit to interactive views (which use ai.FORMAT_CONCURRENCY)
+PREFORMAT_CONCURRENCY = 1
+
+
+class PreformatScheduler:
+    """
+    Formats recently saved pages in the background, so they are ready before anyone opens them.
+
+    Pages are formatted one at a time, newest first, within a budget of tokens per (sliding)
+    hour, and only while no interactive formatting is running in this process.  format_page
+    should go through the same flights as interactive views, so that opening a page while it is
+    being pre-formatted attaches to that run instead of starting another.  When more than
+    `max_pending` pages are waiting, the oldest are dropped; they'll be formatted when viewed.
+    """
+    def __init__(self,
+                 flights: SingleFlight,
+                 format_page: Callable[[UUID, UUID], AsyncIterator[str]],
+                 tokens_per_hour: int,
+                 max_pending: int = 1000) -> None:
+        self.flights = flights
+        self.format_page = format_page
+        self.tokens_per_hour = tokens_per_hour
+        self.max_pending = max_pending
+        self._pending = []  # heap of (-url_id.time, seq, user_id, url_id, n_tokens)
+        self._seq = count()
+        self._spent = deque()  # (monotonic time, tokens)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_task: Optional[asyncio.Task] = None
+
+    def submit(self, user_id: UUID, url_id: UUID, n_tokens: int) -> None:
+        """Queues a newly saved page, which will cost about n_tokens to format"""
+        if n_tokens > self.tokens_per_hour:
+            # would never fit in the budget
+            return
+        self._ensure_started()
+        heapq.heappush(self._pending, (-url_id.time, next(self._seq), user_id, url_id, n_tokens))
+        if len(self._pending) > self.max_pending:
+            # a sorted list is a heap
+            self._pending = heapq.nsmallest(self.max_pending, self._pending)
+        self._wakeup.set()
+
+    def _ensure_started(self) -> None:
+        # the worker is started lazily since it has to live on the server's event loop
+        if self._worker_task is None:
+            self._wakeup = asyncio.Event()
+            self._worker_task = asyncio.create_task(self._worker())
+
+    def _tokens_spent(self) -> int:
+        cutoff = time.monotonic() - 3600
+        while self._spent and self._spent[0][0] < cutoff:
+            self._spent.popleft()
+        return sum(tokens for _, tokens in self._spent)
+
+    async def _wait_for_turn(self, n_tokens: int) -> None:
+        while True:
+            if self.flights:
+                # someone is waiting on a page; don't compete with them
+                await asyncio.sleep(YIELD_INTERVAL)
+            elif self._tokens_spent() + n_tokens > self.tokens_per_hour:
+                await asyncio.sleep(max(self._spent[0][0] + 3600 - time.monotonic(), YIELD_INTERVAL))
+            else:
+                return
+
+    async def _worker(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            n_tokens = self._pending[0][4]
+            await self._wait_for_turn(n_tokens)
+            if self._pending[0][4] > n_tokens:
+                # a newer, bigger page arrived while waiting; wait for room for that one instead
+                continue
+            _, _, user_id, url_id, n_tokens = heapq.heappop(self._pending)
+            self._spent.append((time.monotonic(), n_tokens))
+            try:
+                async for _ in self.format_page(user_id, url_id):
+                    pass
+            except Exception:
+                traceback.print_exc()
+
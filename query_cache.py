@@ -0,0 +1,123 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import xxhash
+
+
+def normalize_query(text: str) -> str:
+    """Case, width and whitespace variants of a query share one cache key"""
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+class QueryCache:
+    """
+    LRU cache of search query embeddings with a time-to-live, shared by all worker processes.
+
+    Entries live in a small sqlite database, which handles concurrent access from several
+    processes; each process also keeps the most recently used entries in memory.  The database is
+    trimmed back to `capacity` entries, least recently used first, every so often.
+    """
+    _TRIM_EVERY = 100
+
+    def __init__(self,
+                 path: str,
+                 capacity: int = 10_000,
+                 ttl: float = 30 * 24 * 3600,
+                 memory_capacity: int = 1000) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.memory_capacity = memory_capacity
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self._memory: OrderedDict[int, Tuple[np.ndarray, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._puts = 0
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection().execute(
+            """
+            CREATE TABLE IF NOT EXISTS queries (
+            key INTEGER PRIMARY KEY,
+            vector BLOB,
+            created_at REAL,
+            used_at REAL)
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def key(model: str, text: str) -> int:
+        # sqlite integers are signed
+        return xxhash.xxh64_intdigest(f'{model}\0{text}'.encode('utf-8')) - 2**63
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        key = self.key(model, text)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0].tolist()
+        row = self._connection().execute('SELECT vector, created_at FROM queries WHERE key = ?', (key,)).fetchone()
+        if row is None or now - row[1] >= self.ttl:
+            with self._lock:
+                self._memory.pop(key, None)
+                self.misses += 1
+                self.expirations += row is not None
+            return None
+        self._connection().execute('UPDATE queries SET used_at = ? WHERE key = ?', (now, key))
+        vector = np.frombuffer(row[0], dtype=np.float32)
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, vector, row[1])
+        return vector.tolist()
+
+    def put(self, model: str, text: str, vector: List[float]) -> None:
+        key = self.key(model, text)
+        now = time.time()
+        vector = np.asarray(vector, dtype=np.float32)
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO queries (key, vector, created_at, used_at) VALUES (?, ?, ?, ?)',
+                           (key, vector.tobytes(), now, now))
+        with self._lock:
+            self._remember(key, vector, now)
+            self._puts += 1
+            should_trim = self._puts % self._TRIM_EVERY == 0
+        if should_trim:
+            connection.execute('DELETE FROM queries WHERE created_at < ?', (now - self.ttl,))
+            connection.execute('DELETE FROM queries WHERE key NOT IN '
+                               '(SELECT key FROM queries ORDER BY used_at DESC LIMIT ?)', (self.capacity,))
+
+    def _remember(self, key: int, vector: np.ndarray, created_at: float) -> None:
+        self._memory[key] = (vector, created_at)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_capacity:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'memory_size': len(self._memory)}
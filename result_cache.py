@@ -0,0 +1,73 @@
+import copy
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+import numpy as np
+import xxhash
+
+
+class SearchResultCache:
+    """
+    In-memory LRU cache of search results, invalidated when the user saves anything.
+
+    Each user has a generation number that bump() increments whenever their pages change, and
+    results are only served if they were cached under the current generation.  The generation is
+    the size of a per-user file that bump() appends a byte to, so saves by other worker processes
+    invalidate this process's entries too, at the cost of a stat() per lookup.
+    """
+    def __init__(self, path: str, capacity: int = 1000) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, Tuple[int, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _generation_path(self, user_id: UUID) -> str:
+        return os.path.join(self.path, str(user_id))
+
+    def generation(self, user_id: UUID) -> int:
+        try:
+            return os.stat(self._generation_path(user_id)).st_size
+        except FileNotFoundError:
+            return 0
+
+    def bump(self, user_id: UUID) -> None:
+        # appends are atomic, so concurrent bumps from several processes are all counted
+        with open(self._generation_path(user_id), 'ab') as f:
+            f.write(b'.')
+
+    @staticmethod
+    def key(user_id: UUID, vector: List[float], *limits) -> tuple:
+        return (user_id, xxhash.xxh64_intdigest(np.asarray(vector, dtype=np.float32).tobytes()), *limits)
+
+    def get(self, key: tuple) -> Optional[Any]:
+        generation = self.generation(key[0])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # callers decorate the results they get back
+            return copy.deepcopy(entry[1])
+
+    def put(self, key: tuple, generation: int, results: Any) -> None:
+        """Caches results computed under `generation`, which the caller read before searching"""
+        with self._lock:
+            self._entries[key] = (generation, copy.deepcopy(results))
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries)}
@@ -0,0 +1,75 @@
+import scriptutil
+scriptutil.update_sys_path()
+
+import argparse
+from typing import Tuple
+from uuid import UUID
+
+from cassandra.concurrent import execute_concurrent_with_args
+from tqdm import tqdm
+
+from config import db
+from db import DB
+
+
+def _in_page_order(text_content: str, title: str, chunks: list) -> Tuple[list, int]:
+    """
+    The chunks sorted by where they appear in the page's text, and how many weren't found there.
+    The legacy table doesn't record the chunks' order, but each one came from the page's text,
+    except the title, which chunking puts first when the text doesn't include it.  Chunks that
+    aren't found go last.
+    """
+    def position(chunk):
+        i = text_content.find(chunk)
+        if i >= 0:
+            return i
+        return -1 if chunk == title else len(text_content)
+    positions = {chunk: position(chunk) for chunk in chunks}
+    n_unplaced = sum(chunk != title and chunk not in text_content for chunk in chunks)
+    return sorted(chunks, key=positions.get), n_unplaced
+
+
+def backfill_chunks(user_ids, dry_run: bool = False) -> None:
+    """Copies the legacy text-keyed chunks into saved_page_chunks, skipping pages that are already there"""
+    # the legacy table was never bucketed, so this always copies into the unbucketed tables
+    source = db if db.legacy_chunks else DB(db.cluster, legacy_chunks=True)
+    if user_ids is None:
+        user_ids = source.user_ids()
+
+    n_pages = n_chunks = n_unplaced = 0
+    for user_id in user_ids:
+        done = {url_id for url_id, _ in source.chunk_ids(user_id)}
+        pages = source.legacy_chunk_pages(user_id)
+        for url_id, chunks in tqdm(pages.items(), desc=str(user_id)):
+            if url_id in done:
+                continue
+            page = source.load_snapshot(user_id, url_id)
+            if page is None:
+                continue
+            embeddings = source.load_legacy_chunks(user_id, url_id, chunks)
+            chunks, unplaced = _in_page_order(page.text_content or '', page.title, [chunk for chunk in chunks if chunk in embeddings])
+            if unplaced:
+                tqdm.write(f"{unplaced} of {len(chunks)} chunks of {page.full_url} ({url_id}) aren't in its text, ordered last")
+                n_unplaced += unplaced
+            params = [(*source._page_pk(user_id, url_id), url_id, ordinal, page.full_url, page.title,
+                       chunk, embeddings[chunk]) for ordinal, chunk in enumerate(chunks)]
+            if not dry_run:
+                execute_concurrent_with_args(source.session, source.statements['insert_chunk'], params,
+                                             concurrency=16, raise_on_first_error=True)
+            n_pages += 1
+            n_chunks += len(params)
+
+    print(f"{'Would copy' if dry_run else 'Copied'} {n_chunks} chunks of {n_pages} pages"
+          f" ({n_unplaced} chunks not found in their page's text, ordered last)")
+    if db.bucketed and n_chunks:
+        print("Run scripts/migrate_buckets.py again to copy them to the bucketed tables")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy chunks from the legacy chunk table to saved_page_chunks. "
+                                                 "Unset LEGACY_CHUNKS once it has finished.")
+    parser.add_argument("--user", type=UUID, action="append", help="Only backfill this user id (may be repeated)")
+    parser.add_argument("--dry-run", action="store_true", help="Count what would be copied without writing")
+    args = parser.parse_args()
+
+    backfill_chunks(args.user, args.dry_run)
@@ -0,0 +1,54 @@
+import scriptutil
+scriptutil.update_sys_path()
+
+import argparse
+import gzip
+import time
+from typing import Callable, List
+
+import zstandard
+
+import codec
+from train_codec_dicts import raw_samples, html_samples
+
+
+def _measure(name: str, samples: List[bytes], compress: Callable, decompress: Callable) -> None:
+    start = time.perf_counter()
+    blobs = [compress(sample) for sample in samples]
+    compress_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for blob in blobs:
+        decompress(blob)
+    decompress_seconds = time.perf_counter() - start
+
+    raw_mb = sum(len(sample) for sample in samples) / 1e6
+    compressed_mb = sum(len(blob) for blob in blobs) / 1e6
+    print(f"  {name:<12} ratio {raw_mb / compressed_mb:6.2f}  "
+          f"compress {raw_mb / compress_seconds:8.1f} MB/s  decompress {raw_mb / decompress_seconds:8.1f} MB/s")
+
+
+def bench(kind: str, samples: List[bytes], dict_size: int) -> None:
+    # train on half and measure on the other half, so the dictionary hasn't seen the test data
+    train, test = samples[::2], samples[1::2]
+    print(f"{kind}: {len(test)} samples, {sum(len(s) for s in test) / len(test) / 1024:.1f} KB average")
+    level = codec._LEVELS[kind]
+
+    _measure('gzip', test, gzip.compress, gzip.decompress)
+    plain = zstandard.ZstdCompressor(level=level)
+    _measure('zstd', test, plain.compress, zstandard.ZstdDecompressor().decompress)
+    d = zstandard.train_dictionary(dict_size, train)
+    with_dict = zstandard.ZstdCompressor(level=level, dict_data=d)
+    _measure('zstd+dict', test, with_dict.compress, zstandard.ZstdDecompressor(dict_data=d).decompress)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare compression ratio and speed of gzip, zstd and zstd with a trained dictionary.")
+    parser.add_argument("--samples", type=int, default=1000, help="Samples of each kind")
+    parser.add_argument("--size", type=int, default=112_640, help="Dictionary size in bytes")
+    args = parser.parse_args()
+
+    for kind, samples in (('raw', raw_samples(args.samples)), ('html', html_samples(args.samples))):
+        if len(samples) < 20:
+            print(f"{kind}: only {len(samples)} samples, skipping")
+            continue
+        bench(kind, samples, args.size)
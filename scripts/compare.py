@@ -3,9 +3,8 @@ scriptutil.update_sys_path()
 
 import os
 import sys
-import gzip
-import json
-from pathlib import Path
+from itertools import islice
+import archive
 import fingerprint
 
 
@@ -15,32 +14,25 @@ def compare_files(directory, master_index):
         print(f"Error: '{directory}' is not a valid directory.")
         sys.exit(1)
 
-    all_files = []
-    for root, _, files in os.walk(directory):
-        all_files.extend([os.path.join(root, fname) for fname in files if fname.endswith('.gz')])
-
-    # sort by filename which is numeric
-    all_files.sort(key=lambda x: int(Path(x).stem))
-
     # Check if the index is valid
-    if master_index < 0 or master_index >= len(all_files):
-        print(f"Error: Invalid index {master_index}. Must be between 0 and {len(all_files) - 1}.")
+    master = next(islice(archive.iter_requests(directory), master_index, None), None) if master_index >= 0 else None
+    if master is None:
+        n_requests = sum(1 for _ in archive.iter_requests(directory))
+        print(f"Error: Invalid index {master_index}. Must be between 0 and {n_requests - 1}.")
         sys.exit(1)
 
-    # compare the fingerprint of the file at the given index with the others
-    master_file_path = all_files[master_index]
-    print(f"Comparing with {master_file_path}")
-
-    with gzip.open(master_file_path, 'rt') as f:
-        data = json.load(f)
-    master_fingerprint = fingerprint.encode(data['text_content'])
-
-    # Walk through the directory
-    for file_path in all_files:
-        with gzip.open(file_path, 'rt') as f:
-            data = json.load(f)
-        similarity = fingerprint.similarity(master_fingerprint, fingerprint.encode(data['text_content']))
-        print(f"{Path(file_path).name}: {similarity}")
+    # compare the fingerprint of the request at the given index with the others
+    print(f"Comparing with {master.user_id}/{master.timestamp_ns}")
+    master_fingerprint = fingerprint.encode(master.load()['text_content'])
+
+    # Stream through the archive, fingerprinting a batch of requests at a time
+    batch_size = 64
+    requests = archive.iter_requests(directory)
+    while batch := list(islice(requests, batch_size)):
+        texts = [request.load()['text_content'] for request in batch]
+        for request, fp in zip(batch, fingerprint.encode_many(texts)):
+            similarity = fingerprint.similarity(master_fingerprint, fp)
+            print(f"{request.timestamp_ns}: {similarity}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import scriptutil
+scriptutil.update_sys_path()
+
+import argparse
+from itertools import islice
+from uuid import UUID
+
+from cassandra.concurrent import execute_concurrent_with_args
+from tqdm import tqdm
+
+from config import db
+from db import DB, month_of
+
+
+def _batches(rows, size=100):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def _select(source: DB, table: str, columns: str, user_id):
+    where = "WHERE user_id = ?" if user_id else ""
+    statement = source.session.prepare(f"SELECT {columns} FROM {source.keyspace}.{table} {where}")
+    statement.fetch_size = 100
+    return source.session.execute(statement, (user_id,) if user_id else None)
+
+
+def migrate_buckets(user_id=None) -> None:
+    """Copies pages and chunks from the unbucketed tables to the month-bucketed ones"""
+    source = DB(db.cluster) if db.bucketed else db
+    target = db if db.bucketed else DB(db.cluster, bucketed=True)
+    # content_gz isn't part of insert_page, since new pages are formatted later
+    insert_page = target.session.prepare(
+        f"""
+        INSERT INTO {target.keyspace}.{target.table_pages}
+        (user_id, month, url_id, full_url, title, text_content, content_gz, fingerprint, minhashes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """
+    )
+
+    # buckets are added before the rows in them, as upsert_chunks_async does
+    buckets = set()
+    rows = _select(source, source.table_pages, "user_id, url_id", user_id)
+    for row in tqdm(rows, desc="Listing buckets"):
+        buckets.add((row.user_id, month_of(row.url_id)))
+    buckets = list(buckets)
+    results = execute_concurrent_with_args(target.session, target.statements['add_bucket'], buckets,
+                                           concurrency=16, raise_on_first_error=False)
+    failed = [(bucket, result) for bucket, (success, result) in zip(buckets, results) if not success]
+    if failed:
+        # rows in a bucket that isn't listed would be invisible, so don't copy any
+        for (bucket_user_id, month), error in failed:
+            print(f"Failed to add bucket {month} for {bucket_user_id}: {error}")
+        raise SystemExit(f"Failed to add {len(failed)} of {len(buckets)} buckets; nothing was copied, run again")
+
+    rows = _select(source, source.table_pages,
+                   "user_id, url_id, full_url, title, text_content, content_gz, fingerprint, minhashes", user_id)
+    n_pages = 0
+    for batch in _batches(tqdm(rows, desc="Copying pages")):
+        params = [(row.user_id, month_of(row.url_id), row.url_id, row.full_url, row.title,
+                   row.text_content, row.content_gz, row.fingerprint, row.minhashes) for row in batch]
+        execute_concurrent_with_args(target.session, insert_page, params, concurrency=16, raise_on_first_error=True)
+        n_pages += len(params)
+
+    # run scripts/backfill_chunks.py first; only the saved_page_chunks layout is copied
+    rows = _select(source, source.table_chunks, "user_id, url_id, ordinal, full_url, title, chunk, embedding_g4", user_id)
+    n_chunks = 0
+    for batch in _batches(tqdm(rows, desc="Copying chunks")):
+        params = [(row.user_id, month_of(row.url_id), row.url_id, row.ordinal, row.full_url, row.title,
+                   row.chunk, row.embedding_g4) for row in batch]
+        execute_concurrent_with_args(target.session, target.statements['insert_chunk'], params,
+                                     concurrency=16, raise_on_first_error=True)
+        n_chunks += len(params)
+
+    print(f"Copied {n_pages} pages and {n_chunks} chunks into {len(buckets)} buckets")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy saved pages and chunks into the month-bucketed tables. "
+                                                 "Set BUCKETED_TABLES once it has finished.")
+    parser.add_argument("--user", type=UUID, help="Only migrate this user id")
+    args = parser.parse_args()
+
+    migrate_buckets(args.user)
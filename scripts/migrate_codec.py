@@ -0,0 +1,44 @@
+import scriptutil
+scriptutil.update_sys_path()
+
+import argparse
+from tqdm import tqdm
+
+from config import db
+import codec
+
+
+def migrate_snapshots(dry_run: bool = False) -> None:
+    """Recompresses formatted snapshots that are not in the current codec format"""
+    select_query = db.session.prepare(
+        f"""
+        SELECT user_id, url_id, content_gz
+        FROM {db.keyspace}.{db.table_pages}
+        """
+    )
+    select_query.fetch_size = 100
+
+    n_migrated = n_current = bytes_before = bytes_after = 0
+    for row in tqdm(db.session.execute(select_query), desc="Migrating snapshots"):
+        if not row.content_gz:
+            continue
+        if codec.is_current(row.content_gz, 'html'):
+            n_current += 1
+            continue
+        content_gz = codec.compress(codec.decompress(row.content_gz), 'html')
+        if not dry_run:
+            db.save_formatting(row.user_id, row.url_id, content_gz)
+        n_migrated += 1
+        bytes_before += len(row.content_gz)
+        bytes_after += len(content_gz)
+
+    print(f"{'Would migrate' if dry_run else 'Migrated'} {n_migrated} snapshots "
+          f"({bytes_before:,} -> {bytes_after:,} bytes), {n_current} already current")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompress stored snapshots with the current codec.")
+    parser.add_argument("--dry-run", action="store_true", help="Report savings without writing")
+    args = parser.parse_args()
+
+    migrate_snapshots(args.dry_run)
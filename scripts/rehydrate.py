@@ -1,23 +1,25 @@
 import scriptutil
 scriptutil.update_sys_path()
 
+import argparse
+import asyncio
 import os
-import gzip
-import json
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from tqdm import tqdm
 import random
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from uuid import UUID, getnode
-from pathlib import Path
 
 from config import db, tr_data_dir
-from logic import save_if_new
+import archive
+import logic
 
 
-def is_processed(file_path: str) -> bool:
-    """Check if a marker file exists for the given file path."""
-    marker_path = f"{file_path}.processed"
-    return os.path.exists(marker_path)
+# one line per processed request: "<user_id>/<timestamp_ns>\t<result>"
+checkpoint_path = os.path.join(tr_data_dir, 'rehydrate.checkpoint')
 
 
 _last_timestamp = None
@@ -44,51 +46,138 @@ def uuid_from_timestamp(nanoseconds: int) -> UUID:
                         clock_seq_hi_variant, clock_seq_low, node), version=1)
 
 
-def process_file(file_path):
-    user_id = UUID(os.path.basename(os.path.dirname(file_path)))
-    file = os.path.basename(file_path)
-
-    # Read and parse the gzipped JSON file
-    with gzip.open(file_path, 'rt') as f:
-        data: Dict[str, Any] = json.load(f)
-    # Extract necessary information
-    url = data['url']
-    title = data['title']
-    text_content = data['text_content']
-    # Extract timestamp from filename and create UUID
-    timestamp_ns = int(file.split('.')[0])
-    saved_at_uuid = uuid_from_timestamp(timestamp_ns)
-    # save to db
-    print(f"Processing: {file_path}")
-    save_result = save_if_new(db, url, title, text_content, user_id, saved_at_uuid)
-    # Mark processed
-    marker_path = f"{file_path}.processed"
-    open(marker_path, 'w').close()
-    return save_result
-
-
-def rehydrate():
-    # load all filenames
-    all_files = []
+def load_checkpoint() -> set:
+    """Keys ("<user_id>/<timestamp_ns>") of the requests that have already been processed"""
+    processed = set()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            processed.update(line.split('\t', 1)[0].removesuffix('.gz') for line in f)
+    # honor the marker files left by older versions of this script
     for root, _, files in os.walk(tr_data_dir):
-        all_files.extend([os.path.join(root, fname) for fname in files if fname.endswith('.gz')])
-    # sort by filename which is numeric
-    all_files.sort(key=lambda x: int(Path(x).stem))
-
-    # filter files
-    unprocessed_files = [file_path for file_path in tqdm(all_files, desc="Checking processed files") if not is_processed(file_path)]
-
-    # Process files
-    n_saved = 0
-    n_errors = 0
-    n_duplicates = 0
-    for file_path in unprocessed_files:
-        if process_file(file_path)['result'] == 'saved':
-            n_saved += 1
-        else:
-            n_duplicates += 1
-    n_already_processed = len(all_files) - len(unprocessed_files)
-    print(f"Saved {n_saved} new pages, skipped {n_duplicates} duplicates, and skipped {n_already_processed} already-processed.")
+        processed.update(os.path.join(os.path.relpath(root, tr_data_dir), fname[:-len('.gz.processed')])
+                         for fname in files if fname.endswith('.gz.processed'))
+    return processed
+
+
+def prepare_request(payload: bytes):
+    """Decompress, fingerprint and chunk one archived request.  Runs in the process pool."""
+    data: Dict[str, Any] = archive.decode(payload)
+    if logic.is_ignored(data['url']):
+        return data['url'], None
+    return data['url'], logic.prepare_article(data['text_content'], data['title'])
+
+
+class RateLimiter:
+    def __init__(self, max_per_second: Optional[float]) -> None:
+        self.interval = 1 / max_per_second if max_per_second else 0
+        self.next_at = time.monotonic()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        now = time.monotonic()
+        delay = self.next_at - now
+        self.next_at = max(self.next_at, now) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def rehydrate_requests(requests, n_processes: int, concurrency: int, max_rate: Optional[float]) -> Counter:
+    loop = asyncio.get_running_loop()
+    results = Counter()
+    limiter = RateLimiter(max_rate)
+    in_flight = asyncio.Semaphore(concurrency)
+    # Each page is deduplicated only after the previous page from the same user, so that (as when
+    # running serially) the earliest copy of a page is the one that is kept.  Pages that pass are
+    # reserved in the dedup index right away, before they are written, and released if they fail to save.
+    last_dedup: Dict[UUID, asyncio.Future] = {}
+    progress = tqdm(desc="Rehydrating")
+
+    async def process(checkpoint, key, user_id, url_id, prepared, previous, deduplicated):
+        try:
+            try:
+                url, article = await prepared
+                if previous:
+                    await previous
+                duplicate = article is not None and \
+                            await db.similar_page_exists_async(user_id, article.fingerprint, article.minhashes)
+                if article is not None and not duplicate:
+                    db.reserve_page(user_id, url_id, article.minhashes)
+            finally:
+                deduplicated.set_result(None)
+            if article is None:
+                result = 'ignored'
+            elif duplicate:
+                result = 'duplicate'
+            else:
+                try:
+                    await logic.store_prepared_async(db, article, url, user_id, url_id)
+                except Exception:
+                    # it wasn't saved, so it mustn't make later copies of it look like duplicates
+                    db.release_page(user_id, url_id)
+                    raise
+                result = 'saved'
+            checkpoint.write(f"{key}\t{result}\n")
+            checkpoint.flush()
+        except Exception as e:
+            result = 'error'
+            print(f"Error processing {key}: {e}")
+        finally:
+            in_flight.release()
+        results[result] += 1
+        progress.update()
+
+    with ProcessPoolExecutor(n_processes) as pool, open(checkpoint_path, 'a') as checkpoint:
+        tasks = []
+        for request in requests:
+            await in_flight.acquire()
+            await limiter.wait()
+            user_id = UUID(request.user_id)
+            # create a UUID from the time the request was archived
+            url_id = uuid_from_timestamp(request.timestamp_ns)
+            prepared = loop.run_in_executor(pool, prepare_request, request.payload)
+            previous = last_dedup.get(user_id)
+            deduplicated = last_dedup[user_id] = loop.create_future()
+            key = f"{request.user_id}/{request.timestamp_ns}"
+            tasks.append(asyncio.create_task(process(checkpoint, key, user_id, url_id, prepared, previous, deduplicated)))
+            tasks = [task for task in tasks if not task.done()]
+        await asyncio.gather(*tasks)
+    progress.close()
+    return results
+
+
+def rehydrate(users: Optional[set] = None,
+              since: Optional[datetime] = None,
+              until: Optional[datetime] = None,
+              n_processes: int = os.cpu_count(),
+              concurrency: int = 64,
+              max_rate: Optional[float] = None) -> None:
+    since_ns = int(since.timestamp() * 1e9) if since else None
+    until_ns = int(until.timestamp() * 1e9) if until else None
+    processed = load_checkpoint()
+    requests = (request for request in archive.iter_requests(tr_data_dir, users, since_ns, until_ns)
+                if f"{request.user_id}/{request.timestamp_ns}" not in processed)
+
+    # load the dedup index up front, so pages deduplicate against each other without the ANN query
+    # (which doesn't see the pages reserved while they are in flight); every user stays loaded
+    db.band_index.max_users = None
+    for user_id in users or archive.user_ids(tr_data_dir):
+        db.load_band_index(UUID(user_id))
+
+    results = asyncio.run(rehydrate_requests(requests, n_processes, concurrency, max_rate))
+    print(f"Saved {results['saved']} new pages, skipped {results['duplicate']} duplicates "
+          f"and {results['ignored']} ignored, {results['error']} errors.")
+
 
 if __name__ == "__main__":
-    rehydrate()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load archived requests from the data directory into the database.")
+    parser.add_argument("--user", action="append", help="Only rehydrate this user id (may be repeated)")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Only rehydrate pages saved at or after this date")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="Only rehydrate pages saved before this date")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Processes for fingerprinting and chunking")
+    parser.add_argument("--concurrency", type=int, default=64, help="Pages in flight at once")
+    parser.add_argument("--max-rate", type=float, help="Maximum pages per second")
+    args = parser.parse_args()
+
+    rehydrate(set(args.user) if args.user else None, args.since, args.until,
+              args.processes, args.concurrency, args.max_rate)
@@ -19,12 +19,12 @@ def update_page_titles():
         """
     )
 
-    # Prepare the update statement
+    # Prepare the update statement; with bucketed tables the partition key includes the month
     update_query = db.session.prepare(
         f"""
         UPDATE {db.keyspace}.{db.table_pages}
         SET title = ?
-        WHERE user_id = ? AND url_id = ?
+        WHERE {db._partition} AND url_id = ?
         """
     )
 
@@ -39,7 +39,7 @@ def update_page_titles():
             new_title = summarize(text)
             print(f"{row.title} -> {new_title}")
             # Update the title in the database
-            # db.session.execute(update_query, (new_title, (row.user_id), (row.url_id)))
+            # db.session.execute(update_query, (new_title, *db._page_pk(row.user_id, row.url_id), row.url_id))
             n_updated += 1
 
     print(f"{n_updated} titles updated")
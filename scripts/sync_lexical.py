@@ -0,0 +1,27 @@
+import scriptutil
+scriptutil.update_sys_path()
+
+import argparse
+import sys
+from uuid import UUID
+
+from config import db, lexical
+
+
+def sync_lexical(user_ids) -> None:
+    if user_ids is None:
+        user_ids = db.user_ids()
+    for user_id in user_ids:
+        added, removed = lexical.sync(db, user_id)
+        print(f"{user_id}: {added} chunks indexed, {removed} removed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring the local lexical index up to date with the database.")
+    parser.add_argument("--user", type=UUID, action="append", help="Only sync this user id (may be repeated)")
+    args = parser.parse_args()
+
+    if lexical is None:
+        print("The lexical index is not enabled; set LEXICAL_DIR")
+        sys.exit(1)
+    sync_lexical(args.user)
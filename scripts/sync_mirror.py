@@ -0,0 +1,27 @@
+import scriptutil
+scriptutil.update_sys_path()
+
+import argparse
+import sys
+from uuid import UUID
+
+from config import db, mirror
+
+
+def sync_mirror(user_ids) -> None:
+    if user_ids is None:
+        user_ids = db.user_ids()
+    for user_id in user_ids:
+        added, removed = mirror.sync(db, user_id)
+        print(f"{user_id}: {added} chunks added or updated, {removed} removed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bring the local search mirror up to date with the database.")
+    parser.add_argument("--user", type=UUID, action="append", help="Only sync this user id (may be repeated)")
+    args = parser.parse_args()
+
+    if mirror is None:
+        print("The mirror is not enabled; set MIRROR_DIR")
+        sys.exit(1)
+    sync_mirror(args.user)
@@ -0,0 +1,53 @@
+import scriptutil
+scriptutil.update_sys_path()
+
+import argparse
+import json
+import random
+from typing import Iterator, List
+
+from config import db, tr_data_dir
+import archive
+import codec
+
+
+def _reservoir(items: Iterator[bytes], n: int) -> List[bytes]:
+    """A uniform random sample of n items, without holding all of them in memory"""
+    sample = []
+    for i, item in enumerate(items):
+        if i < n:
+            sample.append(item)
+        else:
+            j = random.randint(0, i)
+            if j < n:
+                sample[j] = item
+    return sample
+
+
+def raw_samples(n: int) -> List[bytes]:
+    """Uncompressed archived requests"""
+    requests = (json.dumps(request.load()).encode('utf-8') for request in archive.iter_requests(tr_data_dir))
+    return _reservoir(requests, n)
+
+
+def html_samples(n: int) -> List[bytes]:
+    """Uncompressed formatted snapshots"""
+    query = db.session.prepare(f"SELECT content_gz FROM {db.keyspace}.{db.table_pages}")
+    query.fetch_size = 100
+    rows = db.session.execute(query)
+    return _reservoir((codec.decompress(row.content_gz) for row in rows if row.content_gz), n)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train compression dictionaries for archived requests and formatted snapshots.")
+    parser.add_argument("--samples", type=int, default=2000, help="Samples to train each dictionary on")
+    parser.add_argument("--size", type=int, default=112_640, help="Dictionary size in bytes")
+    args = parser.parse_args()
+
+    for kind, samples in (('raw', raw_samples(args.samples)), ('html', html_samples(args.samples))):
+        if len(samples) < 10:
+            print(f"Only {len(samples)} {kind} samples, not training a dictionary")
+            continue
+        path = codec.train_dictionary(samples, kind, args.size)
+        print(f"Trained {kind} dictionary on {len(samples)} samples: {path}")
+    print(f"Deploy the dictionaries in {codec.dictionary_dir}/ with every server before running migrate_codec.py")
@@ -0,0 +1,73 @@
+import asyncio
+import traceback
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.pieces: List = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.updated = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self) -> None:
+        # wake everyone waiting on the current event, and give later waiters a fresh one
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+
+class SingleFlight:
+    """
+    Runs at most one producer per key at a time, and lets any number of readers follow it.
+
+    The first stream() for a key starts the producer as a task; later calls for the same key while
+    it is running attach to it, replaying what it has already emitted before following along.  The
+    producer runs to completion even if every reader goes away, so its work isn't wasted.  Flights
+    are per process: readers in other worker processes start their own.
+    """
+    def __init__(self) -> None:
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def stream(self, key: Hashable, produce: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """Everything the flight for `key` emits, starting one with produce() if none is running"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, produce()))
+        return self._follow(flight)
+
+    async def _run(self, key: Hashable, flight: _Flight, pieces: AsyncIterator) -> None:
+        try:
+            async for piece in pieces:
+                flight.pieces.append(piece)
+                flight.notify()
+        except Exception as e:
+            print(f"Flight {key} failed: {e}")
+            traceback.print_exc()
+            flight.error = e
+        finally:
+            flight.done = True
+            del self._flights[key]
+            flight.notify()
+
+    @staticmethod
+    async def _follow(flight: _Flight) -> AsyncIterator:
+        i = 0
+        while True:
+            updated = flight.updated
+            while i < len(flight.pieces):
+                yield flight.pieces[i]
+                i += 1
+            if flight.done:
+                if flight.error:
+                    raise flight.error
+                return
+            await updated.wait()
+